@@ -2,18 +2,67 @@ from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 from config import settings
 import models, schemas, database
 import logging
+import asyncio
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger("RealEgo")
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+class UserCache:
+    """
+    LRU cache of access token -> user identity (id, username), so authenticated
+    requests skip the user lookup. Entries expire after AUTH_USER_CACHE_TTL
+    seconds or when the token does, whichever is first.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict() # token -> (expires_at, schemas.User)
+        self._lock = threading.Lock() # crud's sync functions invalidate from worker threads
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at < time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return user
+
+    def put(self, token: str, user: schemas.User, token_exp: Optional[float] = None):
+        if self.ttl <= 0:
+            return
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        with self._lock:
+            self._entries[token] = (expires_at, user)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_username(self, username: str):
+        with self._lock:
+            for token in [t for t, (_, u) in self._entries.items() if u.username == username]:
+                del self._entries[token]
+
+user_cache = UserCache(settings.AUTH_USER_CACHE_SIZE, settings.AUTH_USER_CACHE_TTL)
+
 def verify_password(plain_password, hashed_password):
     try:
         result = pwd_context.verify(plain_password, hashed_password)
@@ -26,6 +75,40 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class PasswordHashPool:
+    """
+    Runs bcrypt hashing/verification off the event loop on a dedicated, bounded
+    thread pool (bcrypt releases the GIL while hashing, so threads run in parallel).
+    When more than max_pending jobs are queued or running, callers get a 503
+    instead of piling up behind a login burst.
+    """
+    def __init__(self, workers: int, max_pending: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.max_pending = max_pending
+        self.pending = 0 # Only touched from the event loop thread
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            logger.warning(f"Password hash pool saturated ({self.pending} pending), rejecting request")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, please retry shortly",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+password_hash_pool = PasswordHashPool(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_PENDING)
+
+async def verify_password_async(plain_password, hashed_password):
+    return await password_hash_pool.run(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await password_hash_pool.run(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -36,12 +119,15 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> schemas.User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    cached = user_cache.get(token)
+    if cached is not None:
+        return cached
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         username: str = payload.get("sub")
@@ -50,7 +136,22 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = db.query(models.User).filter(models.User.username == token_data.username).first()
+    # A session of its own, closed right away: a request-scoped one would keep its
+    # transaction (and connection) open for as long as a streamed response runs
+    async with database.AsyncSessionLocal() as db:
+        result = await db.execute(select(models.User).where(models.User.username == token_data.username))
+        user = result.scalars().first()
     if user is None:
         raise credentials_exception
-    return user
+    # Only the identity is cached (never the password hash); handlers use id and username.
+    identity = schemas.User(id=user.id, username=user.username)
+    user_cache.put(token, identity, payload.get("exp"))
+    return identity
+
+async def require_internal(request: Request, x_internal_token: Optional[str] = Header(None)):
+    """Guard for operational endpoints: the client IP is in INTERNAL_ALLOW_IPS or it sends INTERNAL_TOKEN."""
+    if request.client is not None and request.client.host in settings.INTERNAL_ALLOW_IPS:
+        return
+    if settings.INTERNAL_TOKEN and x_internal_token and hmac.compare_digest(x_internal_token, settings.INTERNAL_TOKEN):
+        return
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed")
@@ -7,7 +7,16 @@ class Settings:
     MYSQL_USER = "tera"
     MYSQL_PASSWORD = os.getenv("TERA_MYSQL_PASS", "tera") # Default or from env
     MYSQL_DB = "realego" # Assuming a DB name, will need to create if not exists
-    DATABASE_URL = f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}"
+    DATABASE_URL = os.getenv("DATABASE_URL", f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}")
+    # Used by the request handlers. For local testing point both URLs at SQLite, e.g.
+    # DATABASE_URL=sqlite:///./realego.db ASYNC_DATABASE_URL=sqlite+aiosqlite:///./realego.db
+    ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", f"mysql+aiomysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}")
+    # Connection pool (per engine, per worker process)
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10")) # Seconds to wait for a free connection
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800")) # Seconds, keep below the server's wait_timeout
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
 
     # TOS
     TOS_ENDPOINT = "terazhu.tos-cn-beijing.volces.com"
@@ -15,19 +24,108 @@ class Settings:
     TOS_AK = os.getenv("TERA_TOS_AK")
     TOS_SK = os.getenv("TERA_TOS_SK")
     TOS_BUCKET = "realego-data" # Will use a specific bucket name
+    TOS_UPLOAD_MAX_BYTES = int(os.getenv("TOS_UPLOAD_MAX_BYTES", str(1024 * 1024 * 1024))) # Larger uploads get a 413
+    TOS_PART_SIZE = int(os.getenv("TOS_PART_SIZE", str(8 * 1024 * 1024))) # Multipart part size, TOS minimum is 5 MB
+    # The SDK is blocking: its calls run on TOS_MAX_WORKERS threads, further calls wait their turn
+    TOS_MAX_WORKERS = int(os.getenv("TOS_MAX_WORKERS", "16"))
+    TOS_MAX_CONNECTIONS = int(os.getenv("TOS_MAX_CONNECTIONS", "64"))
+    TOS_CONNECT_TIMEOUT = int(os.getenv("TOS_CONNECT_TIMEOUT", "5")) # Seconds
+    TOS_SOCKET_TIMEOUT = int(os.getenv("TOS_SOCKET_TIMEOUT", "30")) # Seconds without progress on a request
+    TOS_MAX_RETRIES = int(os.getenv("TOS_MAX_RETRIES", "3"))
+    TOS_UPLOAD_MAX_INFLIGHT_PARTS = int(os.getenv("TOS_UPLOAD_MAX_INFLIGHT_PARTS", "4")) # Parallel parts per upload
+    TOS_PRESIGN_EXPIRES = int(os.getenv("TOS_PRESIGN_EXPIRES", "3600")) # Seconds a presigned upload URL stays valid
 
     # Mem0
     MEM0_API_URL = "https://mp-cnlfuzsxoqiw9z9gzpw8swn6bobu.mem0.ivolces.com:8000"
     MEM0_API_KEY = os.getenv("MEM_KEY", "95af5d48-a629-5cdb-b914-341ae85313a6")
+    MEM0_SEARCH_CACHE_TTL = float(os.getenv("MEM0_SEARCH_CACHE_TTL", "30")) # Seconds, 0 disables
+    MEM0_SEARCH_CACHE_SIZE = int(os.getenv("MEM0_SEARCH_CACHE_SIZE", "1024"))
+    MEM0_CONNECT_TIMEOUT = float(os.getenv("MEM0_CONNECT_TIMEOUT", "3"))
+    MEM0_TIMEOUT = float(os.getenv("MEM0_TIMEOUT", "10"))
+    MEM0_MAX_CONNECTIONS = int(os.getenv("MEM0_MAX_CONNECTIONS", "64"))
+    # Separate in-flight limits so memory writes never queue ahead of searches
+    MEM0_SEARCH_CONCURRENCY = int(os.getenv("MEM0_SEARCH_CONCURRENCY", "32"))
+    MEM0_WRITE_CONCURRENCY = int(os.getenv("MEM0_WRITE_CONCURRENCY", "8"))
+    # Write-behind memory queue (memory_outbox table)
+    MEMORY_QUEUE_POLL_INTERVAL = float(os.getenv("MEMORY_QUEUE_POLL_INTERVAL", "2"))
+    MEMORY_QUEUE_BATCH_DELAY = float(os.getenv("MEMORY_QUEUE_BATCH_DELAY", "5")) # Hold new turns so follow-ups share a call
+    MEMORY_QUEUE_BATCH_ROWS = int(os.getenv("MEMORY_QUEUE_BATCH_ROWS", "200"))
+    MEMORY_QUEUE_MAX_TURNS_PER_CALL = int(os.getenv("MEMORY_QUEUE_MAX_TURNS_PER_CALL", "20"))
+    MEMORY_QUEUE_MAX_ATTEMPTS = int(os.getenv("MEMORY_QUEUE_MAX_ATTEMPTS", "8"))
+    MEMORY_QUEUE_RETRY_BASE = float(os.getenv("MEMORY_QUEUE_RETRY_BASE", "5")) # Seconds, doubled per attempt
+    MEMORY_QUEUE_RETRY_MAX = float(os.getenv("MEMORY_QUEUE_RETRY_MAX", "600"))
+    MEMORY_QUEUE_LEASE = float(os.getenv("MEMORY_QUEUE_LEASE", "120")) # Claimed rows return to the queue after this; a pass claims only what it submits within it
+    MEMORY_QUEUE_JOB_POLL_INTERVAL = float(os.getenv("MEMORY_QUEUE_JOB_POLL_INTERVAL", "5"))
+    MEMORY_QUEUE_JOB_TIMEOUT = float(os.getenv("MEMORY_QUEUE_JOB_TIMEOUT", "3600")) # Stop tracking a job after this
 
     # LLM (ARK)
     ARK_API_URL = "https://ark.cn-beijing.volces.com/api/v3"
     ARK_API_KEY = os.getenv("ARK_API_KEY")
     ARK_MODEL = "ep-20251211110617-l2jqj"
 
+    # Chat pipeline: per-source timeouts (seconds) for the pre-LLM fan-out.
+    # A source that times out is skipped and the turn continues without it.
+    CHAT_PROFILE_TIMEOUT = float(os.getenv("CHAT_PROFILE_TIMEOUT", "2"))
+    CHAT_MEMORY_TIMEOUT = float(os.getenv("CHAT_MEMORY_TIMEOUT", "3"))
+    CHAT_HISTORY_TIMEOUT = float(os.getenv("CHAT_HISTORY_TIMEOUT", "2"))
+    CHAT_CONTEXT_MESSAGES = int(os.getenv("CHAT_CONTEXT_MESSAGES", "20")) # Prior messages considered, packed by PROMPT_TOKEN_BUDGET
+    # Streamed replies: deltas are merged into one frame per window (0 sends every delta), the first goes out at once
+    CHAT_STREAM_FLUSH_MS = float(os.getenv("CHAT_STREAM_FLUSH_MS", "20"))
+    CHAT_STREAM_FLUSH_CHARS = int(os.getenv("CHAT_STREAM_FLUSH_CHARS", "512")) # Flush early once this much text is buffered
+    # Chat turns stay buffered for reconnects (GET /chat/stream/{id}): bytes kept per turn, seconds kept after it ends
+    CHAT_STREAM_REPLAY_BYTES = int(os.getenv("CHAT_STREAM_REPLAY_BYTES", str(1024 * 1024)))
+    CHAT_STREAM_REPLAY_TTL = float(os.getenv("CHAT_STREAM_REPLAY_TTL", "120"))
+    CHAT_STREAM_ABANDON_SECONDS = float(os.getenv("CHAT_STREAM_ABANDON_SECONDS", "10")) # Generation stops once no client has followed a turn this long
+    CHAT_WS_SEND_QUEUE = int(os.getenv("CHAT_WS_SEND_QUEUE", "32")) # Frames buffered per WebSocket before generation waits for the client
+    CHAT_WS_AUTH_TIMEOUT = float(os.getenv("CHAT_WS_AUTH_TIMEOUT", "10")) # Seconds a new WebSocket has to send its auth frame
+    # Prompt assembly (services/prompt.py): total input tokens per turn and per-section caps
+    PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "4000"))
+    PROMPT_PROFILE_TOKENS = int(os.getenv("PROMPT_PROFILE_TOKENS", "300"))
+    PROMPT_MEMORY_TOKENS = int(os.getenv("PROMPT_MEMORY_TOKENS", "1000"))
+    PROMPT_MEMORY_ITEM_TOKENS = int(os.getenv("PROMPT_MEMORY_ITEM_TOKENS", "200")) # Longer memories are cut
+    PROMPT_SUMMARY_TOKENS = int(os.getenv("PROMPT_SUMMARY_TOKENS", "600"))
+    # Rolling conversation summary (services/summarizer.py): older messages are folded into
+    # a per-user summary in the background, the newest SUMMARY_KEEP_RECENT always stay raw
+    SUMMARY_EVERY_MESSAGES = int(os.getenv("SUMMARY_EVERY_MESSAGES", "20")) # Due messages that trigger an update, 0 disables
+    SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", str(CHAT_CONTEXT_MESSAGES)))
+    SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "100")) # Max messages per LLM call
+    SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "500"))
+
+    # Admission control for upstream LLM work (chat turns, voice recordings), per process.
+    # Beyond the limits requests queue; a full queue or a wait over the timeout gets a 429
+    LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "32"))
+    LLM_MAX_CONCURRENT_PER_USER = int(os.getenv("LLM_MAX_CONCURRENT_PER_USER", "2"))
+    LLM_MAX_WAITING = int(os.getenv("LLM_MAX_WAITING", "64"))
+    LLM_ADMISSION_TIMEOUT = float(os.getenv("LLM_ADMISSION_TIMEOUT", "10")) # Seconds a request may wait for a slot
+
+    # Voice profile: recordings are cut into fixed windows (needs ffmpeg) and transcribed in parallel
+    FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+    VOICE_SEGMENT_SECONDS = int(os.getenv("VOICE_SEGMENT_SECONDS", "60"))
+    VOICE_TRANSCRIBE_CONCURRENCY = int(os.getenv("VOICE_TRANSCRIBE_CONCURRENCY", "4")) # Per recording
+
+    # Serialized /chat/history and /users/me/profile bodies kept in memory (single process only), 0 disables
+    RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+
+    # Logging
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json") # "json" or "text"
+    LOG_FILE_MAX_BYTES = int(os.getenv("LOG_FILE_MAX_BYTES", str(50 * 1024 * 1024)))
+    LOG_FILE_BACKUP_COUNT = int(os.getenv("LOG_FILE_BACKUP_COUNT", "5"))
+    # Prompt/response bodies: fraction of requests whose payloads are logged, and max chars kept
+    LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.05"))
+    LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "500"))
+
     # Security
     SECRET_KEY = "your-secret-key-here" # Change in production
     ALGORITHM = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES = 30
+    AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "300")) # Seconds, 0 disables
+    AUTH_USER_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", "10000"))
+    # bcrypt runs on its own thread pool; beyond MAX_PENDING queued jobs logins get a 503
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+    PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+    # /internal and /metrics: open to these client IPs, or to requests with X-Internal-Token (empty disables the token)
+    INTERNAL_ALLOW_IPS = [ip.strip() for ip in os.getenv("INTERNAL_ALLOW_IPS", "127.0.0.1,::1").split(",") if ip.strip()]
+    INTERNAL_TOKEN = os.getenv("INTERNAL_TOKEN", "")
 
 settings = Settings()
@@ -6,7 +6,7 @@ import logging
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from database import SessionLocal
-import crud, schemas, auth
+import crud, schemas
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -23,9 +23,7 @@ def create_manual_user():
         
         if user:
             logger.info(f"User '{username}' already exists (ID: {user.id}). Updating password...")
-            hashed_password = auth.get_password_hash(password)
-            user.hashed_password = hashed_password
-            db.commit()
+            crud.update_user_password(db, user, password)
             logger.info("Password updated successfully.")
         else:
             logger.info(f"User '{username}' does not exist. Creating...")
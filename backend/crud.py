@@ -1,5 +1,11 @@
+from sqlalchemy import select, delete, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import models, schemas, auth
+from services.response_cache import response_cache
+from services.timeline import CATEGORIES, encode_value, decode_value
+import json
 import logging
 
 logger = logging.getLogger("RealEgo")
@@ -31,6 +37,7 @@ def create_user(db: Session, user: schemas.UserCreate):
         db_profile = models.Profile(user_id=db_user.id)
         db.add(db_profile)
         db.commit()
+        auth.user_cache.invalidate_username(user.username)
         logger.debug(f"User created successfully: {user.username}, ID: {db_user.id}")
         return db_user
     except Exception as e:
@@ -38,6 +45,14 @@ def create_user(db: Session, user: schemas.UserCreate):
         db.rollback()
         raise e
 
+def update_user_password(db: Session, user: models.User, password: str):
+    user.hashed_password = auth.get_password_hash(password)
+    db.commit()
+    # Cached identities for this user must be re-validated against the DB.
+    # Only affects this process; other processes rely on AUTH_USER_CACHE_TTL.
+    auth.user_cache.invalidate_username(user.username)
+    return user
+
 def get_profile(db: Session, user_id: int):
     return db.query(models.Profile).filter(models.Profile.user_id == user_id).first()
 
@@ -48,19 +63,43 @@ def update_profile(db: Session, user_id: int, profile: schemas.ProfileUpdate):
         db.add(db_profile)
     
     profile_data = profile.dict(exclude_unset=True)
+    timeline_data = profile_data.pop("timeline_data", None)
     for key, value in profile_data.items():
         setattr(db_profile, key, value)
+    if timeline_data is not None:
+        replace_timeline(db, user_id, json.loads(timeline_data))
+        db_profile.timeline_data = None # Legacy column, superseded by timeline_entries
     
     db.commit()
     db.refresh(db_profile)
+    response_cache.bump(user_id)
     return db_profile
 
-def create_chat_message(db: Session, user_id: int, role: str, content: str):
+def replace_timeline(db: Session, user_id: int, timeline: dict):
+    """Make the user's timeline exactly `timeline`. Does not commit."""
+    db.execute(delete(models.TimelineEntry).where(
+        models.TimelineEntry.user_id == user_id,
+        models.TimelineEntry.category.notin_(list(timeline)),
+    ))
+    rows = {row.category: row for row in db.query(models.TimelineEntry).filter(models.TimelineEntry.user_id == user_id)}
+    for category, value in timeline.items():
+        _set_timeline_row(db, rows, user_id, category, value)
+
+def _set_timeline_row(db, rows: dict, user_id: int, category: str, value):
+    content = encode_value(value)
+    row = rows.get(category)
+    if row is None:
+        db.add(models.TimelineEntry(user_id=user_id, category=category, content=content))
+    elif row.content != content:
+        row.content = content
+
+def create_chat_message(db: Session, user_id: int, role: str, content: str, truncated: bool = False):
     try:
-        db_msg = models.ChatMessage(user_id=user_id, role=role, content=content)
+        db_msg = models.ChatMessage(user_id=user_id, role=role, content=content, truncated=truncated)
         db.add(db_msg)
         db.commit()
         db.refresh(db_msg)
+        response_cache.bump(user_id)
         return db_msg
     except Exception as e:
         logger.error(f"Error creating chat message: {e}")
@@ -80,3 +119,208 @@ def get_chat_history(db: Session, user_id: int, limit: int = 100):
     except Exception as e:
         logger.error(f"Error fetching chat history: {e}")
         return []
+
+# Async versions of the functions above, used by the request handlers.
+# The sync versions remain for startup tasks and the CLI scripts.
+
+async def get_user_async(db: AsyncSession, user_id: int):
+    result = await db.execute(select(models.User).where(models.User.id == user_id))
+    return result.scalars().first()
+
+async def get_user_by_username_async(db: AsyncSession, username: str):
+    try:
+        result = await db.execute(select(models.User).where(models.User.username == username))
+        user = result.scalars().first()
+        if user:
+            logger.debug(f"Found user in DB: {username}, ID: {user.id}")
+        else:
+            logger.debug(f"User not found in DB: {username}")
+        return user
+    except Exception as e:
+        logger.error(f"Database error querying user {username}: {e}")
+        return None
+
+async def create_user_async(db: AsyncSession, user: schemas.UserCreate):
+    logger.debug(f"Attempting to create user: {user.username}")
+    try:
+        hashed_password = await auth.get_password_hash_async(user.password)
+        db_user = models.User(username=user.username, hashed_password=hashed_password)
+        db.add(db_user)
+        await db.flush()
+        # Create empty profile
+        db.add(models.Profile(user_id=db_user.id))
+        await db.commit()
+        auth.user_cache.invalidate_username(user.username)
+        logger.debug(f"User created successfully: {user.username}, ID: {db_user.id}")
+        return db_user
+    except Exception as e:
+        logger.error(f"Error creating user {user.username}: {e}")
+        await db.rollback()
+        raise e
+
+async def update_user_password_async(db: AsyncSession, user: models.User, password: str):
+    user.hashed_password = await auth.get_password_hash_async(password)
+    await db.commit()
+    auth.user_cache.invalidate_username(user.username)
+    return user
+
+async def get_profile_async(db: AsyncSession, user_id: int):
+    result = await db.execute(select(models.Profile).where(models.Profile.user_id == user_id))
+    return result.scalars().first()
+
+async def update_profile_async(db: AsyncSession, user_id: int, profile: schemas.ProfileUpdate):
+    db_profile = await get_profile_async(db, user_id)
+    if not db_profile:
+        db_profile = models.Profile(user_id=user_id)
+        db.add(db_profile)
+    
+    profile_data = profile.dict(exclude_unset=True)
+    timeline_data = profile_data.pop("timeline_data", None)
+    for key, value in profile_data.items():
+        setattr(db_profile, key, value)
+    if timeline_data is not None:
+        await replace_timeline_async(db, user_id, json.loads(timeline_data))
+        db_profile.timeline_data = None # Legacy column, superseded by timeline_entries
+    
+    await db.commit()
+    await db.refresh(db_profile)
+    response_cache.bump(user_id)
+    return db_profile
+
+async def create_chat_message_async(db: AsyncSession, user_id: int, role: str, content: str, truncated: bool = False):
+    try:
+        db_msg = models.ChatMessage(user_id=user_id, role=role, content=content, truncated=truncated)
+        db.add(db_msg)
+        await db.commit()
+        response_cache.bump(user_id)
+        return db_msg
+    except Exception as e:
+        logger.error(f"Error creating chat message: {e}")
+        await db.rollback()
+        return None
+
+async def get_chat_history_async(db: AsyncSession, user_id: int, limit: int = 100):
+    # Same result as get_chat_history: newest N by ID, returned oldest first
+    return await get_chat_history_page_async(db, user_id, limit)
+
+async def get_chat_history_page_async(db: AsyncSession, user_id: int, limit: int = 100, before_id: int = None, after_id: int = None):
+    """
+    Keyset-paginated history, oldest first, served by ix_chat_messages_user_id_id.
+    - after_id: up to `limit` messages newer than after_id (incremental refresh)
+    - before_id: the `limit` messages just older than before_id (scrolling back)
+    - neither: the newest `limit` messages
+    Returns lightweight rows (id, role, content, timestamp, truncated) rather than ORM objects.
+    """
+    try:
+        query = select(
+            models.ChatMessage.id,
+            models.ChatMessage.role,
+            models.ChatMessage.content,
+            models.ChatMessage.timestamp,
+            models.ChatMessage.truncated,
+        ).where(models.ChatMessage.user_id == user_id)
+        if after_id is not None:
+            query = query.where(models.ChatMessage.id > after_id).order_by(models.ChatMessage.id.asc()).limit(limit)
+            return list((await db.execute(query)).all())
+        if before_id is not None:
+            query = query.where(models.ChatMessage.id < before_id)
+        query = query.order_by(models.ChatMessage.id.desc()).limit(limit)
+        return list(reversed((await db.execute(query)).all()))
+    except Exception as e:
+        logger.error(f"Error fetching chat history: {e}")
+        return []
+
+async def get_uploaded_object_async(db: AsyncSession, user_id: int, sha256: str):
+    result = await db.execute(select(models.UploadedObject).where(
+        models.UploadedObject.user_id == user_id,
+        models.UploadedObject.sha256 == sha256,
+    ))
+    return result.scalars().first()
+
+async def create_uploaded_object_async(db: AsyncSession, user_id: int, sha256: str, object_key: str, size: int, filename: str = None, content_type: str = None):
+    """Add an upload to the content index (sha256 None: recorded, not deduplicated). If the same content was recorded concurrently, returns that row instead."""
+    db_object = models.UploadedObject(
+        user_id=user_id, sha256=sha256, object_key=object_key, size=size, filename=filename, content_type=content_type
+    )
+    db.add(db_object)
+    try:
+        await db.commit()
+        return db_object
+    except IntegrityError:
+        await db.rollback()
+        return await get_uploaded_object_async(db, user_id, sha256)
+
+async def get_timeline_async(db: AsyncSession, user_id: int, categories: list = None):
+    """The user's timeline as {category: value}, optionally only the given categories."""
+    query = select(models.TimelineEntry.category, models.TimelineEntry.content).where(models.TimelineEntry.user_id == user_id)
+    if categories is not None:
+        query = query.where(models.TimelineEntry.category.in_(categories))
+    rows = (await db.execute(query)).all()
+    if not rows and categories is None:
+        return await _migrate_legacy_timeline_async(db, user_id)
+    order = list(CATEGORIES)
+    rows = sorted(rows, key=lambda r: order.index(r.category) if r.category in order else len(order))
+    return {row.category: decode_value(row.content) for row in rows}
+
+async def _migrate_legacy_timeline_async(db: AsyncSession, user_id: int):
+    # Profiles written before timeline_entries existed keep the whole timeline in one JSON column
+    profile = await get_profile_async(db, user_id)
+    if not profile or not profile.timeline_data:
+        return {}
+    try:
+        timeline = json.loads(profile.timeline_data)
+    except ValueError:
+        logger.error(f"Unreadable legacy timeline_data for user {user_id}, leaving it in place")
+        return {}
+    if isinstance(timeline, dict):
+        await replace_timeline_async(db, user_id, timeline)
+    profile.timeline_data = None
+    await db.commit()
+    logger.info(f"Moved legacy timeline of user {user_id} to timeline_entries ({len(timeline)} categories)")
+    return timeline if isinstance(timeline, dict) else {}
+
+async def upsert_timeline_async(db: AsyncSession, user_id: int, changes: dict):
+    """Insert or update only the given categories, e.g. the ones a voice update changed."""
+    if not changes:
+        return
+    result = await db.execute(select(models.TimelineEntry).where(
+        models.TimelineEntry.user_id == user_id,
+        models.TimelineEntry.category.in_(list(changes)),
+    ))
+    rows = {row.category: row for row in result.scalars().all()}
+    for category, value in changes.items():
+        _set_timeline_row(db, rows, user_id, category, value)
+    await db.commit()
+    response_cache.bump(user_id)
+
+async def replace_timeline_async(db: AsyncSession, user_id: int, timeline: dict):
+    """Make the user's timeline exactly `timeline`. Does not commit."""
+    await db.execute(delete(models.TimelineEntry).where(
+        models.TimelineEntry.user_id == user_id,
+        models.TimelineEntry.category.notin_(list(timeline)),
+    ))
+    result = await db.execute(select(models.TimelineEntry).where(models.TimelineEntry.user_id == user_id))
+    rows = {row.category: row for row in result.scalars().all()}
+    for category, value in timeline.items():
+        _set_timeline_row(db, rows, user_id, category, value)
+
+async def get_summary_async(db: AsyncSession, user_id: int):
+    result = await db.execute(select(models.ConversationSummary).where(models.ConversationSummary.user_id == user_id))
+    return result.scalars().first()
+
+async def save_summary_async(db: AsyncSession, user_id: int, summary: str, last_message_id: int):
+    db_summary = await get_summary_async(db, user_id)
+    if not db_summary:
+        db_summary = models.ConversationSummary(user_id=user_id)
+        db.add(db_summary)
+    db_summary.summary = summary
+    db_summary.last_message_id = last_message_id
+    await db.commit()
+    return db_summary
+
+async def count_chat_messages_after_async(db: AsyncSession, user_id: int, after_id: int = 0):
+    result = await db.execute(select(func.count(models.ChatMessage.id)).where(
+        models.ChatMessage.user_id == user_id,
+        models.ChatMessage.id > after_id,
+    ))
+    return result.scalar() or 0
@@ -1,7 +1,12 @@
+import time
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from config import settings
+from services.metrics import Counter, Histogram
 
 # Note: We might need to create the database first if it doesn't exist.
 # For now, assuming the user 'tera' has permissions to create DB or it exists.
@@ -11,9 +16,43 @@ from config import settings
 
 SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+pool_wait_seconds = Histogram("realego_db_pool_wait_seconds", "Time spent waiting for a pooled DB connection", labelnames=("engine",))
+pool_timeouts_total = Counter("realego_db_pool_timeouts_total", "Connection checkouts that hit DB_POOL_TIMEOUT", labelnames=("engine",))
+
+def _timed_pool(base, engine_name: str):
+    """Subclass a pool so every checkout records how long it waited for a connection."""
+    class TimedPool(base):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            except PoolTimeoutError:
+                pool_timeouts_total.inc(engine=engine_name)
+                raise
+            finally:
+                pool_wait_seconds.observe(time.perf_counter() - start, engine=engine_name)
+    TimedPool.__name__ = f"Timed{base.__name__}"
+    return TimedPool
+
+def _pool_options():
+    return dict(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=_timed_pool(QueuePool, "sync"), **_pool_options())
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for request handlers, so DB round-trips do not block the event loop.
+# The sync engine above is kept for startup tasks and the CLI scripts.
+async_engine = create_async_engine(settings.ASYNC_DATABASE_URL, poolclass=_timed_pool(AsyncAdaptedQueuePool, "async"), **_pool_options())
+# expire_on_commit=False: objects returned from crud stay readable after commit
+# without an implicit (and, under asyncio, illegal) lazy refresh.
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 def get_db():
@@ -22,3 +61,24 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def pool_stats():
+    """Current occupancy and checkout wait times for both engines' pools."""
+    waits = pool_wait_seconds.snapshot()
+    timeouts = pool_timeouts_total.snapshot()
+    stats = {}
+    for name, pool in (("sync", engine.pool), ("async", async_engine.pool)):
+        stats[name] = {
+            "pool_size": pool.size(),
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "timeouts": timeouts.get((name,), 0),
+            "wait_seconds": waits.get((name,), {"buckets": {}, "sum": 0.0, "count": 0}),
+        }
+    return stats
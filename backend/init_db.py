@@ -1,7 +1,7 @@
 import sys
 import os
 import pymysql
-from sqlalchemy import text, create_engine
+from sqlalchemy import text, create_engine, inspect
 from config import settings
 
 # Add current directory to path so we can import modules
@@ -64,10 +64,38 @@ def init_db():
             except Exception:
                 print("'profiles' table does not exist yet. Will be created.")
 
+            print("Checking 'chat_messages' table schema...")
+            try:
+                conn.execute(text("SELECT 1 FROM chat_messages LIMIT 1"))
+
+                # Check for truncated
+                try:
+                    conn.execute(text("SELECT truncated FROM chat_messages LIMIT 1"))
+                    print("'truncated' column already exists.")
+                except Exception:
+                    print("'truncated' column missing. Adding it...")
+                    conn.execute(text("ALTER TABLE chat_messages ADD COLUMN truncated BOOLEAN DEFAULT FALSE"))
+                    print("Added 'truncated' column to 'chat_messages' table.")
+            except Exception:
+                print("'chat_messages' table does not exist yet. Will be created.")
+
             # B. Create all missing tables (including chat_messages and profiles if missing)
             print("Creating missing tables...")
             Base.metadata.create_all(bind=engine)
             print("All tables checked/created.")
+
+            # C. Indexes added after the table existed (create_all skips existing tables)
+            print("Checking 'chat_messages' indexes...")
+            try:
+                existing = {ix["name"] for ix in inspect(conn).get_indexes("chat_messages")}
+                if "ix_chat_messages_user_id_id" in existing:
+                    print("'ix_chat_messages_user_id_id' index already exists.")
+                else:
+                    print("'ix_chat_messages_user_id_id' index missing. Adding it...")
+                    conn.execute(text("CREATE INDEX ix_chat_messages_user_id_id ON chat_messages (user_id, id)"))
+                    print("Added 'ix_chat_messages_user_id_id' index to 'chat_messages' table.")
+            except Exception as e:
+                print(f"Error checking 'chat_messages' indexes: {e}")
             
             print("Database initialization completed successfully.")
             
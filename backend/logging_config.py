@@ -0,0 +1,85 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import uuid
+from config import settings
+
+# Set per request by the log_requests middleware in main.py
+request_id_var = contextvars.ContextVar("request_id", default="-")
+# Whether prompt/response payloads are logged for the current request (None = decide per call)
+payload_sampled_var = contextvars.ContextVar("payload_sampled", default=None)
+
+class RequestContextFilter(logging.Filter):
+    # Runs on the QueueHandler, i.e. in the thread/task that logged, where the contextvars are set
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging(log_file: str):
+    """
+    Route all logging through a queue: callers only enqueue records, and a
+    QueueListener thread does the formatting and the file/stdout writes.
+    """
+    if settings.LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s")
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=settings.LOG_FILE_MAX_BYTES, backupCount=settings.LOG_FILE_BACKUP_COUNT, encoding="utf-8"
+    )
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(settings.LOG_LEVEL.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop) # Flush queued records on shutdown
+    return listener
+
+def new_request_id(incoming: str = None) -> str:
+    """Start logging context for a request: set its id and make the payload sampling decision."""
+    request_id = incoming or uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    payload_sampled_var.set(random.random() < settings.LOG_PAYLOAD_SAMPLE_RATE)
+    return request_id
+
+def log_payload(logger: logging.Logger, label: str, text, level: int = logging.DEBUG):
+    """Log a prompt/response body, sampled per request and truncated to LOG_PAYLOAD_MAX_CHARS."""
+    if not logger.isEnabledFor(level):
+        return
+    sampled = payload_sampled_var.get()
+    if sampled is None:
+        sampled = random.random() < settings.LOG_PAYLOAD_SAMPLE_RATE
+    if not sampled:
+        return
+    text = str(text)
+    if len(text) > settings.LOG_PAYLOAD_MAX_CHARS:
+        text = text[:settings.LOG_PAYLOAD_MAX_CHARS] + f"... [{len(text) - settings.LOG_PAYLOAD_MAX_CHARS} more chars]"
+    logger.log(level, f"{label}: {text}")
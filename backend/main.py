@@ -2,30 +2,27 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from database import engine, Base, SessionLocal
-from routers import auth, users, chat, upload
+from database import engine, Base, AsyncSessionLocal
+from routers import auth, users, chat, upload, internal, metrics
 import models
 import crud, schemas
+from services.mem0 import mem0_service
+from services.memory_queue import memory_queue
+from services.summarizer import conversation_summarizer
+from services.turn_stream import turn_streams
+from services.tos import tos_service
+from logging_config import setup_logging, new_request_id
 import os
 import logging
-import sys
 import time
 from sqlalchemy.orm import Session
-import auth as auth_utils # Import auth module for password hashing
 
 # Logging Configuration
 log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
 os.makedirs(log_dir, exist_ok=True)
 log_file = os.path.join(log_dir, "server.log")
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+setup_logging(log_file)
 logger = logging.getLogger("RealEgo")
 
 # Create DB tables
@@ -41,6 +38,7 @@ app = FastAPI(title="RealEgo Backend")
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     start_time = time.time()
+    request_id = new_request_id(request.headers.get("X-Request-ID"))
     client_host = request.client.host if request.client else "unknown"
     logger.info(f"Incoming connection from {client_host} - {request.method} {request.url.path}")
     
@@ -48,6 +46,7 @@ async def log_requests(request: Request, call_next):
     
     process_time = time.time() - start_time
     logger.info(f"Completed {request.method} {request.url.path} - Status: {response.status_code} - Time: {process_time:.4f}s")
+    response.headers["X-Request-ID"] = request_id
     return response
 
 # CORS
@@ -64,6 +63,8 @@ app.include_router(auth.router)
 app.include_router(users.router)
 app.include_router(chat.router)
 app.include_router(upload.router)
+app.include_router(internal.router)
+app.include_router(metrics.router)
 
 # Serve Frontend
 frontend_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "frontend")
@@ -78,32 +79,29 @@ async def read_home():
     return FileResponse(os.path.join(frontend_path, "home.html"))
 
 # Initialize Default User
-def init_default_user():
-    db = SessionLocal()
-    try:
-        logger.debug("Checking for default user 'tera'...")
-        user = crud.get_user_by_username(db, "tera")
-        if not user:
-            logger.info("Creating default user 'tera'")
-            user_in = schemas.UserCreate(username="tera", password="tera")
-            try:
-                crud.create_user(db, user_in)
-                logger.info("Default user 'tera' created successfully.")
-            except Exception as e:
-                logger.error(f"Failed to create default user: {e}")
-        else:
-            logger.info("Default user 'tera' already exists. Resetting password to ensure validity.")
-            try:
-                hashed_password = auth_utils.get_password_hash("tera")
-                user.hashed_password = hashed_password
-                db.commit()
-                logger.info("Password for 'tera' reset successfully.")
-            except Exception as e:
-                logger.error(f"Failed to reset password for 'tera': {e}")
-    except Exception as e:
-        logger.error(f"Error initializing user: {e}")
-    finally:
-        db.close()
+async def init_default_user():
+    # Async so the bcrypt work runs on the password hash pool, not the event loop
+    async with AsyncSessionLocal() as db:
+        try:
+            logger.debug("Checking for default user 'tera'...")
+            user = await crud.get_user_by_username_async(db, "tera")
+            if not user:
+                logger.info("Creating default user 'tera'")
+                user_in = schemas.UserCreate(username="tera", password="tera")
+                try:
+                    await crud.create_user_async(db, user_in)
+                    logger.info("Default user 'tera' created successfully.")
+                except Exception as e:
+                    logger.error(f"Failed to create default user: {e}")
+            else:
+                logger.info("Default user 'tera' already exists. Resetting password to ensure validity.")
+                try:
+                    await crud.update_user_password_async(db, user, "tera")
+                    logger.info("Password for 'tera' reset successfully.")
+                except Exception as e:
+                    logger.error(f"Failed to reset password for 'tera': {e}")
+        except Exception as e:
+            logger.error(f"Error initializing user: {e}")
 
 @app.on_event("startup")
 async def startup_event():
@@ -117,9 +115,19 @@ async def startup_event():
     except Exception as e:
         logger.error(f"DB initialization failed: {e}")
 
-    init_default_user()
+    await init_default_user()
+    memory_queue.start()
     logger.info("Startup complete.")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    logger.info("Server is shutting down...")
+    await turn_streams.stop()
+    await memory_queue.stop()
+    await conversation_summarizer.stop()
+    await mem0_service.close()
+    tos_service.close()
+
 if __name__ == "__main__":
     import uvicorn
     logger.info("Starting Uvicorn server on port 8080...")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, Text, DateTime
+from sqlalchemy import Column, Integer, String, Date, Text, DateTime, Boolean, Index, UniqueConstraint, BigInteger
 from database import Base
 from datetime import datetime
 
@@ -21,14 +21,73 @@ class Profile(Base):
     family_info = Column(Text) # JSON or text description
     education_history = Column(Text)
     work_history = Column(Text)
-    timeline_data = Column(Text) # JSON string storing the 9 categories
+    timeline_data = Column(Text) # Legacy JSON blob of the 9 categories, moved to timeline_entries on first read
     history_limit = Column(Integer, default=100)
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
+    __table_args__ = (
+        # Serves "WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT n" (keyset pagination) from the index alone
+        Index("ix_chat_messages_user_id_id", "user_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, index=True)
     role = Column(String(20)) # 'user' or 'assistant'
     content = Column(Text)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    truncated = Column(Boolean, default=False) # Reply cut short: generation was cancelled or abandoned
+
+class MemoryOutbox(Base):
+    """Chat turns waiting to be written to Mem0 (see services/memory_queue.py)."""
+    __tablename__ = "memory_outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    messages = Column(Text) # JSON list of {"role": ..., "content": ...}
+    status = Column(String(20), default="pending", index=True) # 'pending', 'submitting', 'submitted' or 'failed'
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, index=True)
+    event_id = Column(String(64)) # Mem0 async job id once submitted
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    submitted_at = Column(DateTime)
+
+class UploadedObject(Base):
+    """Content index for uploads: one TOS object per (user, SHA-256 of the bytes). Uploads without a hash are recorded with sha256 NULL."""
+    __tablename__ = "uploaded_objects"
+    __table_args__ = (
+        UniqueConstraint("user_id", "sha256", name="uq_uploaded_objects_user_sha256"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    sha256 = Column(String(64), nullable=True) # Hex digest; NULL when the client sent none (never deduplicated)
+    object_key = Column(String(255))
+    size = Column(BigInteger)
+    filename = Column(String(255)) # Name at first upload
+    content_type = Column(String(255))
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class TimelineEntry(Base):
+    """One timeline category of a user's life story (see services/timeline.py for the categories)."""
+    __tablename__ = "timeline_entries"
+    __table_args__ = (
+        UniqueConstraint("user_id", "category", name="uq_timeline_entries_user_category"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    category = Column(String(32)) # e.g. '0_birth'
+    content = Column(Text) # JSON-encoded value: a string or an object with details
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ConversationSummary(Base):
+    """Rolling summary of a user's older chat messages (see services/summarizer.py)."""
+    __tablename__ = "conversation_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, unique=True, index=True)
+    summary = Column(Text)
+    last_message_id = Column(Integer, default=0) # Newest chat_messages.id folded into the summary
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import timedelta
 import auth, schemas, crud, database
@@ -11,9 +11,9 @@ logger = logging.getLogger("RealEgo")
 router = APIRouter(tags=["auth"])
 
 @router.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_async_db)):
     logger.debug(f"Login attempt for user: {form_data.username}")
-    user = crud.get_user_by_username(db, username=form_data.username)
+    user = await crud.get_user_by_username_async(db, username=form_data.username)
     if not user:
         logger.debug(f"User not found: {form_data.username}")
         raise HTTPException(
@@ -23,7 +23,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         )
     
     logger.debug(f"User found: {user.username}, verifying password...")
-    if not auth.verify_password(form_data.password, user.hashed_password):
+    if not await auth.verify_password_async(form_data.password, user.hashed_password):
         logger.debug("Password verification failed")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -39,8 +39,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.post("/register", response_model=schemas.User)
-def register_user(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
-    db_user = crud.get_user_by_username(db, username=user.username)
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(database.get_async_db)):
+    db_user = await crud.get_user_by_username_async(db, username=user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    return crud.create_user(db=db, user=user)
+    return await crud.create_user_async(db=db, user=user)
@@ -1,116 +1,468 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-import schemas, auth, models, database, crud
+from sqlalchemy.ext.asyncio import AsyncSession
+from jose import jwt
+import schemas, auth, database, crud
+from config import settings
 from services.llm import llm_service
 from services.mem0 import mem0_service
+from services.memory_queue import memory_queue
+from services.summarizer import conversation_summarizer
+from services.response_cache import response_cache
+from services.turn import TurnContext, chat_stage_seconds, chat_tokens_per_second, chat_errors_total
+from services.stream import StreamEncoder, stream_format, coalesce, json_encoder
+from services.turn_stream import turn_streams, chat_stream_resumes_total, StreamExpired
+from services.admission import llm_admission
 import logging
-import json
+from logging_config import log_payload
 import asyncio
+import json
+import time
 
 logger = logging.getLogger("RealEgo")
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
-from typing import List
+from typing import List, Optional
+from pydantic import TypeAdapter
+
+history_adapter = TypeAdapter(List[schemas.ChatMessage])
+
+async def save_turn(user_id: int, user_message: str, reply: str, truncated: bool = False):
+    """
+    Persist the assistant reply and queue the turn for Mem0 ingestion.
+    truncated marks a reply cut short by cancellation. Runs after the reply
+    was generated, so it gets its own session instead of the request-scoped one.
+    """
+    with chat_stage_seconds.time(stage="db_write"):
+        async with database.AsyncSessionLocal() as db:
+            msg = await crud.create_chat_message_async(db, user_id, "assistant", reply, truncated=truncated)
+            if msg is None:
+                chat_errors_total.inc(stage="db_write")
+            memory_messages = [
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": reply}
+            ]
+            try:
+                await memory_queue.enqueue(db, memory_messages, user_id)
+            except Exception as e:
+                chat_errors_total.inc(stage="memory_enqueue")
+                logger.error(f"Failed to queue memory for user {user_id}: {e!r}")
+    # Folds older messages into the rolling summary once enough have piled up
+    conversation_summarizer.schedule(user_id)
+
+async def load_profile(user_id: int):
+    # Each fan-out source uses its own session: an AsyncSession is not safe for concurrent use
+    async with database.AsyncSessionLocal() as db:
+        return await crud.get_profile_async(db, user_id)
+
+async def load_recent_history(user_id: int, exclude_id: int = None):
+    """
+    The rolling conversation summary and the raw messages after it (before the
+    current one, oldest first), as (summary_text, LLM messages). Without a
+    summary yet, the last CHAT_CONTEXT_MESSAGES messages.
+    """
+    async with database.AsyncSessionLocal() as db:
+        summary = await crud.get_summary_async(db, user_id)
+        if summary:
+            # Everything not yet folded into the summary; prompt_builder drops the oldest if over budget
+            limit = max(settings.CHAT_CONTEXT_MESSAGES, settings.SUMMARY_KEEP_RECENT + settings.SUMMARY_EVERY_MESSAGES)
+        else:
+            limit = settings.CHAT_CONTEXT_MESSAGES
+        messages = await crud.get_chat_history_async(db, user_id, limit + 1)
+    after_id = summary.last_message_id if summary else 0
+    messages = [m for m in messages if m.id != exclude_id and m.id > after_id][-limit:]
+    return (summary.summary if summary else ""), [{"role": m.role, "content": m.content} for m in messages]
 
 @router.get("/history", response_model=List[schemas.ChatMessage])
-async def get_history(current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    profile = crud.get_profile(db, current_user.id)
-    limit = 100
-    if profile and profile.history_limit:
-        limit = profile.history_limit
-    
-    logger.info(f"Fetching chat history for user {current_user.username} with limit {limit}")
-    return crud.get_chat_history(db, current_user.id, limit)
+async def get_history(
+    request: Request,
+    before_id: Optional[int] = Query(None, ge=1),
+    after_id: Optional[int] = Query(None, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    current_user: schemas.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    """
+    Chat history, oldest first. Without parameters returns the newest
+    `history_limit` messages as before; before_id pages further back and
+    after_id returns only messages newer than the last one the client has.
+    Unchanged re-reads are answered from response_cache (or with a 304).
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+
+    async def build():
+        page_limit = limit
+        if page_limit is None:
+            page_limit = 100
+            profile = await crud.get_profile_async(db, current_user.id)
+            if profile and profile.history_limit:
+                page_limit = profile.history_limit
+        logger.info(f"Fetching chat history for user {current_user.username} with limit {page_limit} (before_id={before_id}, after_id={after_id})")
+        rows = await crud.get_chat_history_page_async(db, current_user.id, page_limit, before_id=before_id, after_id=after_id)
+        return history_adapter.dump_json(history_adapter.validate_python(rows, from_attributes=True))
+
+    # The default limit comes from the profile, whose changes bump the same version
+    return await response_cache.respond(request, current_user.id, "history", (limit, before_id, after_id), build)
+
+async def llm_deltas(context: TurnContext, completion):
+    """Text deltas of a streamed completion, recording time to first token and the output rate."""
+    delta_count = 0
+    stream_start = time.perf_counter()
+    async for chunk in completion:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if not delta_count:
+                context.record("time_to_first_token", time.perf_counter() - context.started_at)
+            delta_count += 1
+            yield chunk.choices[0].delta.content
+    stream_seconds = time.perf_counter() - stream_start
+    context.record("stream", stream_seconds)
+    if delta_count and stream_seconds > 0:
+        chat_tokens_per_second.observe(delta_count / stream_seconds)
+
+async def stream_turn(context: TurnContext, encoder: StreamEncoder, sources: dict, reply: list, on_complete):
+    """
+    The chat pipeline shared by the HTTP and WebSocket transports, as encoded
+    events: fan out over `sources` (see TurnContext.fan_out; results land in
+    context), stream the LLM reply into `reply` as it is sent, then call
+    on_complete() once the reply is whole. A failure ends the stream with an
+    error event instead of raising.
+    """
+    stage = "retrieval" # Labels chat_errors_total if the turn fails
+    try:
+        # 1. Load profile, memories and recent history concurrently.
+        # Each source reports as soon as it completes; a slow or failing one is skipped.
+        yield encoder.log("Loading user profile...")
+        yield encoder.log("Searching relevant memories...")
+        async for source, result, error in context.fan_out(sources):
+            if error is not None:
+                logger.warning(f"Chat context source '{source}' unavailable for user {context.username}: {error!r}")
+                yield encoder.log(f"Skipped {source.replace('_', ' ')} (unavailable).")
+            elif source == "profile":
+                context.set_profile(result)
+                yield encoder.log("Profile loaded.")
+            elif source == "memory_search":
+                context.memories = result or []
+                yield encoder.log(f"Found {len(context.memories)} relevant memories.")
+            elif source == "history":
+                context.summary, context.history = result
+                summary_note = " and the conversation summary" if context.summary else ""
+                yield encoder.log(f"Loaded {len(context.history)} recent messages{summary_note}.")
+
+        # 2. Call LLM
+        yield encoder.log("Constructing prompt and waiting for LLM...")
+
+        # Use streaming chat (Async). Memories found above are reused, not searched again.
+        stage = "llm_connect"
+        with context.timed("llm_connect"):
+            completion = await llm_service.chat_with_context(context, stream=True)
+        if isinstance(completion, str):
+            # chat_with_context reports failures as a message instead of a stream
+            raise RuntimeError(completion)
+
+        yield encoder.log("LLM response stream started.")
+
+        stage = "stream"
+        try:
+            # The first delta is sent on its own, later ones are merged per CHAT_STREAM_FLUSH_MS window
+            async for content in coalesce(llm_deltas(context, completion)):
+                if not reply:
+                    yield encoder.log("First token received from LLM.")
+                reply.append(content)
+                yield encoder.chunk(content)
+        finally:
+            # Also when the turn is cancelled: closing the connection stops generation (and billing) upstream
+            await completion.close()
+
+        yield encoder.log("LLM response complete.")
+        logger.debug(f"Turn timings for user {context.username}: {context.timings}")
+
+        # 3. Background Tasks
+        yield encoder.log("Queueing background memory storage...")
+        on_complete()
+        yield encoder.log("All tasks queued. Done.")
+
+    except Exception as e:
+        chat_errors_total.inc(stage=stage)
+        logger.error(f"Error in chat stream ({stage}): {e}")
+        yield encoder.error(str(e))
+
+async def follow_stream(stream, offset: int, encoder: StreamEncoder):
+    """A turn's frames in the response format. A reader that falls behind the replay buffer gets a final error event."""
+    try:
+        async for frame in stream.follow(offset):
+            yield encoder.wrap(frame)
+    except StreamExpired as e:
+        yield encoder.error(str(e))
 
 @router.post("/", response_class=StreamingResponse)
-async def chat(request: schemas.ChatRequest, background_tasks: BackgroundTasks, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    logger.info(f"Received chat request from user {current_user.username}: {request.message}")
+async def chat(
+    request: schemas.ChatRequest,
+    accept: Optional[str] = Header(None),
+    current_user: schemas.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    """
+    Streams the turn as NDJSON events ({"type": "log" | "response_chunk" | "error", "content": ...}),
+    or as Server-Sent Events with the same JSON when the client sends Accept: text/event-stream.
+    The first event, {"type": "stream", "content": <id>}, names the stream to resume if the connection drops.
+    """
+    received_at = time.perf_counter()
+    logger.info(f"Received chat request from user {current_user.username} ({len(request.message)} chars)")
+    log_payload(logger, "Chat message", request.message)
     
+    # Waits for an LLM slot or answers 429 before anything is stored, so the client can simply retry
+    ticket = await llm_admission.acquire(current_user.id)
+
+    context = TurnContext(str(current_user.id), current_user.username, request.message, received_at)
+    encoder = StreamEncoder(stream_format(accept))
+
     # Save user message (Synchronous to ensure order and existence before reply)
-    crud.create_chat_message(db, current_user.id, "user", request.message)
+    try:
+        with context.timed("db_write"):
+            user_msg = await crud.create_chat_message_async(db, current_user.id, "user", request.message)
+    except BaseException:
+        ticket.release()
+        raise
 
-    async def event_generator():
-        try:
-            # 1. Load Profile
-            yield json.dumps({"type": "log", "content": "Loading user profile..."}) + "\n"
-            profile = crud.get_profile(db, current_user.id)
-            profile_dict = {}
-            if profile:
-                profile_dict = {
-                    "username": current_user.username,
-                    "full_name": profile.full_name,
-                    "birth_date": str(profile.birth_date) if profile.birth_date else None,
-                    "location": profile.location,
-                    "family_info": profile.family_info
-                }
-            yield json.dumps({"type": "log", "content": "Profile loaded."}) + "\n"
-
-            # 2. Search Memory
-            # Now explicitly showing the search step and waiting for it
-            yield json.dumps({"type": "log", "content": "Searching relevant memories..."}) + "\n"
-            memories = await mem0_service.search_memory(request.message, str(current_user.id))
-            mem_count = len(memories) if memories else 0
-            yield json.dumps({"type": "log", "content": f"Found {mem_count} relevant memories."}) + "\n"
-
-            # 3. Call LLM
-            yield json.dumps({"type": "log", "content": "Constructing prompt and waiting for LLM..."}) + "\n"
-            
-            # Use streaming chat (Async)
-            completion = await llm_service.chat(request.message, str(current_user.id), profile_dict, stream=True)
-            
-            yield json.dumps({"type": "log", "content": "LLM response stream started."}) + "\n"
-            
-            full_response = ""
-            first_chunk_received = False
-            async for chunk in completion:
-                # Force flush immediately at start of loop to ensure previous log is sent
-                # Note: 'yield' in FastAPI streaming response usually pushes to network buffer.
-                # If we want to ensure it goes out, we rely on the server/client not buffering.
-                
-                if chunk.choices and chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    
-                    if not first_chunk_received:
-                        first_chunk_received = True
-                        yield json.dumps({"type": "log", "content": "First token received from LLM."}) + "\n"
-                        # Force a small pause/yield to ensure the log packet is flushed separately
-                        # This is a hack for some buffering proxies, but also helps browser UI render the log
-                        # before the first text chunk if they arrive in same packet.
-                        await asyncio.sleep(0.01) 
-
-                    full_response += content
-                    # Send partial chunk
-                    yield json.dumps({"type": "response_chunk", "content": content}) + "\n"
-            
-            yield json.dumps({"type": "log", "content": "LLM response complete."}) + "\n"
-            
-            # 4. Background Tasks
-            yield json.dumps({"type": "log", "content": "Queueing background memory storage..."}) + "\n"
-            
-            # Use asyncio.create_task for true non-blocking background work in async handler
-            # FastAPI's background_tasks might run after the response closes, which is fine,
-            # but here we want to log that we are done queueing.
-            background_tasks.add_task(crud.create_chat_message, db, current_user.id, "assistant", full_response)
-            
-            # Add to memory (Async call in background task)
-            # We construct the message list as Mem0 expects
-            memory_messages = [
-                {"role": "user", "content": request.message},
-                {"role": "assistant", "content": full_response}
-            ]
-            background_tasks.add_task(mem0_service.add_memory, memory_messages, str(current_user.id))
-            
-            yield json.dumps({"type": "log", "content": "All tasks queued. Done."}) + "\n"
+    sources = {
+        "profile": (load_profile(current_user.id), settings.CHAT_PROFILE_TIMEOUT),
+        "memory_search": (mem0_service.search_memory(request.message, context.user_id), settings.CHAT_MEMORY_TIMEOUT),
+        "history": (load_recent_history(current_user.id, user_msg.id if user_msg else None), settings.CHAT_HISTORY_TIMEOUT),
+    }
+    reply, complete = [], []
+
+    async def finalize():
+        # Mem0 ingestion goes through the durable memory queue, which batches turns per user.
+        # A cancelled turn keeps the part of the reply that was generated.
+        if complete or reply:
+            await save_turn(current_user.id, request.message, "".join(reply), truncated=not complete)
+
+    # Generation runs in its own task and outlives this response: a client that
+    # drops resumes with GET /chat/stream/{id}?offset=<events received>, or the
+    # turn is cancelled once nobody follows it for CHAT_STREAM_ABANDON_SECONDS
+    stream = turn_streams.start(
+        current_user.id,
+        stream_turn(context, json_encoder, sources, reply, lambda: complete.append(True)),
+        finalize,
+    )
+    # The slot is held for the whole turn, however it ends
+    stream.task.add_done_callback(lambda _: ticket.release())
 
-        except Exception as e:
-            logger.error(f"Error in chat stream: {e}")
-            yield json.dumps({"type": "error", "content": str(e)}) + "\n"
+    return StreamingResponse(
+        follow_stream(stream, 0, encoder),
+        media_type=encoder.media_type, 
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache", "X-Stream-Id": stream.id}
+    )
+
+@router.get("/stream/{stream_id}", response_class=StreamingResponse)
+async def resume_stream(
+    stream_id: str,
+    offset: int = Query(0, ge=0),
+    accept: Optional[str] = Header(None),
+    current_user: schemas.User = Depends(auth.get_current_user),
+):
+    """
+    Reattach to a chat turn started with POST /chat/: replays its events from
+    `offset` (the number of events the client already received, counting the
+    initial "stream" event) and follows it live until the turn ends.
+    """
+    stream = turn_streams.get(stream_id, current_user.id)
+    if stream is None:
+        chat_stream_resumes_total.inc(result="not_found")
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    if offset > stream.end:
+        raise HTTPException(status_code=400, detail=f"Offset beyond the {stream.end} events sent so far")
+    if offset < stream.base:
+        chat_stream_resumes_total.inc(result="expired")
+        raise HTTPException(status_code=410, detail="Requested events are no longer buffered")
+    chat_stream_resumes_total.inc(result="resumed")
+    logger.info(f"User {current_user.username} resumed chat stream {stream_id} at offset {offset}/{stream.end}")
+    encoder = StreamEncoder(stream_format(accept))
 
     return StreamingResponse(
-        event_generator(), 
-        media_type="application/x-ndjson", 
-        background=background_tasks,
-        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+        follow_stream(stream, offset, encoder),
+        media_type=encoder.media_type,
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache", "X-Stream-Id": stream.id}
     )
+
+@router.post("/stream/{stream_id}/cancel")
+async def cancel_stream(stream_id: str, current_user: schemas.User = Depends(auth.get_current_user)):
+    """Stop generating a turn. The reply so far is stored marked truncated; readers get a "cancelled" event."""
+    stream = turn_streams.get(stream_id, current_user.id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    cancelled = stream.cancel("requested")
+    if cancelled:
+        logger.info(f"User {current_user.username} cancelled chat stream {stream_id}")
+    return {"cancelled": cancelled}
+
+class ChatSession:
+    """
+    Per-connection state of a /chat/ws client: the user, and the profile,
+    conversation summary and recent history loaded for the previous turn.
+    Follow-up turns reuse them and only search memories, unless the user's
+    data changed elsewhere (another tab, a profile update; seen through the
+    response_cache version, which every chat message and profile write bumps)
+    or the summarizer may have moved on, in which case they are loaded again.
+    """
+    def __init__(self, user):
+        self.user = user
+        self.profile = None # TurnContext.profile
+        self.summary = ""
+        self.history = []
+        self.version = None # response_cache version the state matches, None = not loaded
+        self.appended = 0 # Messages added to history since it was loaded
+
+    def is_fresh(self) -> bool:
+        if self.version is None or self.version != response_cache.version(self.user.id):
+            return False
+        return settings.SUMMARY_EVERY_MESSAGES <= 0 or self.appended < settings.SUMMARY_EVERY_MESSAGES
+
+    def sources(self, context: TurnContext, fresh: bool, user_msg_id: int = None) -> dict:
+        """Fan-out sources for a turn; with fresh state, context is filled from it instead."""
+        sources = {"memory_search": (mem0_service.search_memory(context.message, context.user_id), settings.CHAT_MEMORY_TIMEOUT)}
+        if fresh:
+            context.profile, context.summary, context.history = self.profile, self.summary, list(self.history)
+        else:
+            sources["profile"] = (load_profile(self.user.id), settings.CHAT_PROFILE_TIMEOUT)
+            sources["history"] = (load_recent_history(self.user.id, user_msg_id), settings.CHAT_HISTORY_TIMEOUT)
+            self.appended = 0
+        return sources
+
+    def remember(self, context: TurnContext, reply: str):
+        """Keep what the turn used plus the new exchange for the next turn."""
+        self.profile, self.summary = context.profile, context.summary
+        self.history = context.history + [
+            {"role": "user", "content": context.message},
+            {"role": "assistant", "content": reply},
+        ]
+        self.history = self.history[-max(settings.CHAT_CONTEXT_MESSAGES, settings.SUMMARY_KEEP_RECENT + settings.SUMMARY_EVERY_MESSAGES):]
+        self.appended += 2
+        # Our own writes bumped the version; a write by anyone else after this makes the state stale
+        self.version = response_cache.version(self.user.id)
+
+async def _ws_authenticate(websocket: WebSocket):
+    """Read the auth frame that opens a chat WebSocket. Returns (user, token), or None after closing the socket."""
+    try:
+        frame = await asyncio.wait_for(websocket.receive(), settings.CHAT_WS_AUTH_TIMEOUT)
+        if frame["type"] == "websocket.disconnect":
+            return None
+        data = json.loads(frame.get("text") or frame.get("bytes") or "")
+        token = data.get("token") if isinstance(data, dict) and data.get("type") == "auth" else None
+        if not isinstance(token, str):
+            raise ValueError("First frame must be an auth frame")
+        user = await auth.get_current_user(token)
+    except (asyncio.TimeoutError, ValueError, HTTPException):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Authentication failed")
+        return None
+    return user, token
+
+@router.websocket("/ws")
+async def chat_ws(websocket: WebSocket):
+    """
+    Chat over one WebSocket per client. The first frame must be
+    {"type": "auth", "token": "..."}, sent within CHAT_WS_AUTH_TIMEOUT; the
+    token never goes in the URL, which ends up in access logs. It is checked
+    once per connection and again only when it expires. The server answers
+    {"type": "ready"}, then takes client frames:
+      {"type": "message", "message": "..."} starts a turn, one at a time
+      {"type": "cancel"} stops the turn in progress (the partial reply is kept)
+    Server frames are the /chat/ events as JSON text, plus {"type": "done"}
+    when a turn ends, or {"type": "busy", "content": <retry after seconds>}
+    instead when no LLM slot was free (the message was not stored). Frames go out through a bounded queue: a client that
+    reads slowly pauses generation instead of buffering the reply in memory.
+    """
+    await websocket.accept()
+    authenticated = await _ws_authenticate(websocket)
+    if authenticated is None:
+        return
+    user, token = authenticated
+    expires_at = jwt.get_unverified_claims(token).get("exp")
+    await websocket.send_text(json_encoder.event("ready", "").decode())
+    logger.info(f"Chat WebSocket opened for user {user.username}")
+
+    session = ChatSession(user)
+    encoder = json_encoder
+    outbox = asyncio.Queue(maxsize=settings.CHAT_WS_SEND_QUEUE)
+    turn = None
+
+    async def send_frames():
+        while True:
+            await websocket.send_text(await outbox.get())
+
+    async def run_turn(message: str):
+        received_at = time.perf_counter()
+        try:
+            ticket = await llm_admission.acquire(user.id)
+        except HTTPException as e:
+            await outbox.put(encoder.event("busy", e.headers.get("Retry-After", "1")).decode())
+            return
+        try:
+            await generate(message, received_at)
+        finally:
+            ticket.release()
+
+    async def generate(message: str, received_at: float):
+        context = TurnContext(str(user.id), user.username, message, received_at)
+        fresh = session.is_fresh() # Before our own write bumps the version
+        with context.timed("db_write"):
+            async with database.AsyncSessionLocal() as db:
+                user_msg = await crud.create_chat_message_async(db, user.id, "user", message)
+        sources = session.sources(context, fresh, user_msg.id if user_msg else None)
+        reply, complete = [], []
+        frames = stream_turn(context, encoder, sources, reply, lambda: complete.append(True))
+        try:
+            async for frame in frames:
+                await outbox.put(frame.decode())
+        finally:
+            # Closes the LLM stream now, not whenever the suspended generator is collected
+            await frames.aclose()
+            # Also on cancel: keep what the user already saw, marked truncated. Shielded
+            # like the HTTP path's finalize, so a cancel or close during the save cannot lose it
+            if reply:
+                text = "".join(reply)
+                await asyncio.shield(asyncio.ensure_future(save_turn(user.id, message, text, truncated=not complete)))
+                session.remember(context, text)
+        await outbox.put(encoder.event("done", "" if complete else "incomplete").decode())
+
+    sender = asyncio.create_task(send_frames())
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            try:
+                data = json.loads(frame.get("text") or frame.get("bytes") or "")
+            except ValueError:
+                # A bad frame is answered like an unknown one; the session stays open
+                await outbox.put(encoder.error("Frames must be JSON.").decode())
+                continue
+            kind = data.get("type") if isinstance(data, dict) else None
+            if expires_at is not None and time.time() >= expires_at:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Token expired")
+                break
+            if kind == "cancel":
+                if turn is not None and not turn.done():
+                    turn.cancel()
+                    await asyncio.gather(turn, return_exceptions=True)
+                    await outbox.put(encoder.event("done", "cancelled").decode())
+            elif kind == "message" and isinstance(data.get("message"), str) and data["message"].strip():
+                if turn is not None and not turn.done():
+                    await outbox.put(encoder.error("A reply is still in progress; cancel it first.").decode())
+                    continue
+                logger.info(f"Received chat message over WebSocket from user {user.username} ({len(data['message'])} chars)")
+                log_payload(logger, "Chat message", data["message"])
+                turn = asyncio.create_task(run_turn(data["message"]))
+            else:
+                await outbox.put(encoder.error("Unknown frame; expected a message or cancel.").decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if turn is not None and not turn.done():
+            turn.cancel()
+            await asyncio.gather(turn, return_exceptions=True)
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+        logger.info(f"Chat WebSocket closed for user {user.username}")
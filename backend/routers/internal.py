@@ -0,0 +1,9 @@
+from fastapi import APIRouter, Depends
+import auth, database
+
+# Operational endpoints, for allow-listed IPs or callers with the internal token
+router = APIRouter(prefix="/internal", tags=["internal"], dependencies=[Depends(auth.require_internal)])
+
+@router.get("/db/pool")
+async def db_pool_stats():
+    return database.pool_stats()
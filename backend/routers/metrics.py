@@ -0,0 +1,11 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+import auth
+from services.metrics import render_prometheus
+
+# Prometheus scrape endpoint; the scraper runs locally or sends X-Internal-Token
+router = APIRouter(tags=["internal"], dependencies=[Depends(auth.require_internal)])
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
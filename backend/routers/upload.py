@@ -1,19 +1,136 @@
 from fastapi import APIRouter, UploadFile, File, Depends, HTTPException
-import auth, models
-from services.tos import tos_service
+from sqlalchemy.ext.asyncio import AsyncSession
+import auth, schemas, crud, database
+import logging
+import os
+import uuid
+from config import settings
+from services.tos import tos_service, UploadTooLarge, upload_deduplicated_total
+
+logger = logging.getLogger("RealEgo")
 
 router = APIRouter(prefix="/upload", tags=["upload"])
 
-@router.post("/")
-async def upload_file(file: UploadFile = File(...), current_user: models.User = Depends(auth.get_current_user)):
-    # Create a unique key
-    import uuid
-    file_ext = file.filename.split(".")[-1]
-    object_key = f"user_{current_user.id}/{uuid.uuid4()}.{file_ext}"
-    
+@router.post("/check")
+async def check_upload(check: schemas.UploadCheck, current_user: schemas.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
+    """
+    Let the client ask by SHA-256 whether it already uploaded this content, so
+    the bytes never have to be sent again.
+    """
+    existing = await crud.get_uploaded_object_async(db, current_user.id, check.sha256.lower())
+    if not existing:
+        return {"exists": False}
+    upload_deduplicated_total.inc(stage="check")
+    return {"exists": True, "filename": check.filename or existing.filename, "url": tos_service.object_url(existing.object_key)}
+
+@router.post("/", response_model=schemas.UploadResult)
+async def upload_file(file: UploadFile = File(...), current_user: schemas.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
+    # The multipart parser has already spooled the body to a temp file, so the size is known up front
+    if file.size is not None and file.size > settings.TOS_UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"File exceeds {settings.TOS_UPLOAD_MAX_BYTES} bytes")
+
     try:
-        contents = await file.read()
-        url = tos_service.upload_file(contents, object_key)
-        return {"filename": file.filename, "url": url}
+        # Hash the spooled file first so known content never goes to TOS again
+        sha256, size = await tos_service.sha256_file(file)
+        existing = await crud.get_uploaded_object_async(db, current_user.id, sha256)
+        if existing:
+            upload_deduplicated_total.inc(stage="upload")
+            logger.info(f"Upload of {file.filename} by user {current_user.id} matches {existing.object_key}, skipping TOS")
+            return {"filename": file.filename, "url": tos_service.object_url(existing.object_key), "deduplicated": True}
+
+        # Content-addressed key: concurrent uploads of the same file write the same object
+        object_key = _object_key(current_user.id, file.filename, sha256)
+        # Streamed to TOS part by part, never read into memory whole
+        await tos_service.upload_stream(file, object_key, content_type=file.content_type)
+        record = await crud.create_uploaded_object_async(
+            db, current_user.id, sha256, object_key, size, filename=file.filename, content_type=file.content_type
+        )
+        return {"filename": file.filename, "url": tos_service.object_url(record.object_key)}
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
+        logger.error(f"Upload of {file.filename} by user {current_user.id} failed: {e!r}")
         raise HTTPException(status_code=500, detail=str(e))
+
+def _object_key(user_id: int, filename: str, sha256: str = None) -> str:
+    file_ext = os.path.splitext(filename or "")[1].lower()
+    # Content-addressed when the hash is known, so the same file always lands on the same object
+    return f"user_{user_id}/{sha256.lower() if sha256 else uuid.uuid4().hex}{file_ext}"
+
+def _own_key(user_id: int, object_key: str):
+    if not object_key.startswith(f"user_{user_id}/") or ".." in object_key:
+        raise HTTPException(status_code=403, detail="Not your object")
+
+@router.post("/presign")
+async def presign_upload(request: schemas.UploadPresign, current_user: schemas.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
+    """
+    Hand out presigned URLs so the browser uploads straight to the bucket.
+    Files up to TOS_PART_SIZE get one PUT URL; larger ones a multipart upload
+    with one URL per part. Finish with POST /upload/complete.
+    """
+    if request.size > settings.TOS_UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"File exceeds {settings.TOS_UPLOAD_MAX_BYTES} bytes")
+    if request.sha256:
+        existing = await crud.get_uploaded_object_async(db, current_user.id, request.sha256.lower())
+        if existing:
+            upload_deduplicated_total.inc(stage="check")
+            return {"deduplicated": True, "filename": request.filename, "url": tos_service.object_url(existing.object_key)}
+
+    object_key = _object_key(current_user.id, request.filename, request.sha256)
+    try:
+        if request.size <= settings.TOS_PART_SIZE:
+            return {"mode": "single", "object_key": object_key, "url": tos_service.presign_put(object_key)}
+        upload_id, part_urls = await tos_service.presign_multipart(object_key, request.size, request.content_type)
+    except Exception as e:
+        logger.error(f"Presigning {object_key} failed: {e!r}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "mode": "multipart",
+        "object_key": object_key,
+        "upload_id": upload_id,
+        "part_size": settings.TOS_PART_SIZE,
+        "part_urls": part_urls,
+    }
+
+@router.post("/complete", response_model=schemas.UploadResult)
+async def complete_upload(request: schemas.UploadComplete, current_user: schemas.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
+    """Called by the browser after its direct upload: finish multipart, verify the object and record it."""
+    _own_key(current_user.id, request.object_key)
+    try:
+        if request.upload_id:
+            await tos_service.complete_multipart(
+                request.object_key, request.upload_id, [(p.part_number, p.etag) for p in request.parts]
+            )
+        size = await tos_service.object_size(request.object_key)
+        if size is None:
+            raise HTTPException(status_code=400, detail="Object was not uploaded")
+        if size > settings.TOS_UPLOAD_MAX_BYTES:
+            # A presigned PUT cannot cap the body size, so enforce the limit here
+            await tos_service.delete_object(request.object_key)
+            raise HTTPException(status_code=413, detail=f"File exceeds {settings.TOS_UPLOAD_MAX_BYTES} bytes")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Completing upload of {request.object_key} failed: {e!r}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    # Every upload is recorded; without a hash it just stays out of the dedup lookup.
+    # The hash is the client's claim; the index is per user, so a wrong one only affects that user's dedup
+    sha256 = request.sha256.lower() if request.sha256 else None
+    record = await crud.create_uploaded_object_async(
+        db, current_user.id, sha256, request.object_key, size,
+        filename=request.filename, content_type=request.content_type,
+    )
+    object_key = record.object_key
+    logger.info(f"Direct upload of {request.object_key} by user {current_user.id} completed ({size} bytes)")
+    return {"filename": request.filename, "url": tos_service.object_url(object_key)}
+
+@router.post("/abort")
+async def abort_upload(request: schemas.UploadAbort, current_user: schemas.User = Depends(auth.get_current_user)):
+    """Drop the parts of a multipart direct upload the browser gave up on."""
+    _own_key(current_user.id, request.object_key)
+    try:
+        await tos_service.abort_multipart(request.object_key, request.upload_id)
+    except Exception as e:
+        logger.warning(f"Aborting upload {request.upload_id} of {request.object_key} failed: {e!r}")
+    return {"aborted": True}
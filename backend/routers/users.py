@@ -1,51 +1,128 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy.ext.asyncio import AsyncSession
 import schemas, crud, database, auth, models
 import json
+import logging
 from services.llm import llm_service
+from services.audio import save_audio
+from services.response_cache import response_cache
+from services.admission import llm_admission
+
+logger = logging.getLogger("RealEgo")
 
 router = APIRouter(prefix="/users", tags=["users"])
 
+def _profile_out(profile, timeline: dict) -> schemas.Profile:
+    # The timeline lives in timeline_entries; responses keep the timeline_data JSON string
+    return schemas.Profile.model_validate(profile).model_copy(update={"timeline_data": json.dumps(timeline) if timeline else None})
+
+async def _load_timeline(user_id: int) -> dict:
+    # A session of its own, closed before transcription starts: a request-scoped
+    # one would keep its connection checked out for the whole recording
+    async with database.AsyncSessionLocal() as db:
+        return await crud.get_timeline_async(db, user_id)
+
 @router.post("/me/profile/voice", response_model=schemas.Profile)
-async def update_profile_voice(file: UploadFile = File(...), current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
+async def update_profile_voice(file: UploadFile = File(...), current_user: schemas.User = Depends(auth.get_current_user)):
     # Get current profile timeline
-    profile = crud.get_profile(db, user_id=current_user.id)
-    current_timeline = json.loads(profile.timeline_data) if profile.timeline_data else {}
+    current_timeline = await _load_timeline(current_user.id)
     
-    # Process audio
-    # llm_service is now async
-    text, json_str = await llm_service.process_voice_profile(file.file, current_timeline)
+    # Same segmented pipeline as the streaming endpoint, answered once it finishes
+    ticket = await llm_admission.acquire(current_user.id)
+    try:
+        segments = await save_audio(file.file, file.filename)
+        transcribed, extracted, errors = False, False, []
+        changes = {}
+        async for event in llm_service.process_voice_profile_stream(segments, current_timeline):
+            if event["type"] == "transcript" and event["content"].strip():
+                transcribed = True
+            elif event["type"] == "timeline":
+                changes.update(event["content"])
+                extracted = True
+            elif event["type"] == "error":
+                errors.append(event["content"])
+    finally:
+        ticket.release()
     
-    if not text:
-        raise HTTPException(status_code=500, detail=f"Voice processing failed: {json_str}")
+    if not transcribed:
+        raise HTTPException(status_code=500, detail=f"Voice processing failed: {'; '.join(errors)}")
+    if not extracted and errors:
+        raise HTTPException(status_code=500, detail=f"Failed to parse LLM output: {'; '.join(errors)}")
         
+    # Save back only the categories that changed
+    async with database.AsyncSessionLocal() as db:
+        await crud.upsert_timeline_async(db, current_user.id, changes)
+        current_timeline.update(changes)
+        profile = await crud.get_profile_async(db, user_id=current_user.id)
+        if not profile:
+            profile = await crud.update_profile_async(db, current_user.id, schemas.ProfileUpdate())
+        return _profile_out(profile, current_timeline)
+
+@router.post("/me/profile/voice/stream", response_class=StreamingResponse)
+async def update_profile_voice_stream(file: UploadFile = File(...), current_user: schemas.User = Depends(auth.get_current_user)):
+    """
+    Voice profile update with NDJSON progress, like /chat/: log, transcript and
+    timeline events as segments finish, then {"type": "done"} with the merged
+    timeline. The categories each batch changed are saved right away.
+    """
+    current_timeline = await _load_timeline(current_user.id)
+    # 429 before the stream starts when no LLM slot frees up
+    ticket = await llm_admission.acquire(current_user.id)
     try:
-        new_data = json.loads(json_str)
-        # Merge logic (simple top-level merge)
-        current_timeline.update(new_data)
-        
-        # Save back
-        updated_profile = crud.update_profile(db, current_user.id, schemas.ProfileUpdate(timeline_data=json.dumps(current_timeline)))
-        return updated_profile
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to parse LLM output: {e}")
+        segments = await save_audio(file.file, file.filename)
+    except BaseException:
+        ticket.release()
+        raise
+    user_id = current_user.id
+
+    def cleanup():
+        # Both are idempotent; runs when the stream ends and again as the background task
+        ticket.release()
+        segments.close()
+
+    async def event_generator():
+        try:
+            timeline = dict(current_timeline)
+            async for event in llm_service.process_voice_profile_stream(segments, current_timeline):
+                if event["type"] == "timeline" and event["content"]:
+                    timeline.update(event["content"])
+                    try:
+                        async with database.AsyncSessionLocal() as session:
+                            await crud.upsert_timeline_async(session, user_id, event["content"])
+                    except Exception as e:
+                        logger.error(f"Saving voice timeline for user {user_id} failed: {e!r}")
+                        yield json.dumps({"type": "error", "content": "Could not save profile update."}) + "\n"
+                yield json.dumps(event) + "\n"
+            yield json.dumps({"type": "done", "content": timeline}) + "\n"
+        finally:
+            cleanup()
+
+    # The background task also cleans up if the client leaves before the stream starts
+    return StreamingResponse(event_generator(), media_type="application/x-ndjson", background=BackgroundTask(cleanup))
 
 @router.get("/me", response_model=schemas.User)
-async def read_users_me(current_user: models.User = Depends(auth.get_current_user)):
+async def read_users_me(current_user: schemas.User = Depends(auth.get_current_user)):
     return current_user
 
 @router.get("/me/profile", response_model=schemas.Profile)
-async def read_own_profile(current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    profile = crud.get_profile(db, user_id=current_user.id)
-    if not profile:
-        # Create default if missing (should be created at register)
-        profile = models.Profile(user_id=current_user.id)
-        db.add(profile)
-        db.commit()
-    return profile
+async def read_own_profile(request: Request, current_user: schemas.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
+    async def build():
+        profile = await crud.get_profile_async(db, user_id=current_user.id)
+        if not profile:
+            # Create default if missing (should be created at register)
+            profile = models.Profile(user_id=current_user.id)
+            db.add(profile)
+            await db.commit()
+        timeline = await crud.get_timeline_async(db, current_user.id)
+        return _profile_out(profile, timeline).model_dump_json().encode()
+
+    return await response_cache.respond(request, current_user.id, "profile", (), build)
 
 @router.put("/me/profile", response_model=schemas.Profile)
-async def update_own_profile(profile: schemas.ProfileUpdate, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
+async def update_own_profile(profile: schemas.ProfileUpdate, current_user: schemas.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
     # Also sync to Mem0 logic here could be added
     # For now just DB update
-    return crud.update_profile(db, user_id=current_user.id, profile=profile)
+    updated = await crud.update_profile_async(db, user_id=current_user.id, profile=profile)
+    return _profile_out(updated, await crud.get_timeline_async(db, current_user.id))
@@ -1,6 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional, List
 from datetime import date, datetime
+import json
 
 class UserBase(BaseModel):
     username: str
@@ -32,7 +33,13 @@ class ProfileBase(BaseModel):
     history_limit: Optional[int] = 100
 
 class ProfileUpdate(ProfileBase):
-    pass
+    @field_validator("timeline_data")
+    @classmethod
+    def timeline_is_object(cls, value):
+        # Stored per category in timeline_entries, so it has to be {category: value}
+        if value is not None and not isinstance(json.loads(value), dict):
+            raise ValueError("timeline_data must be a JSON object")
+        return value
 
 class Profile(ProfileBase):
     id: int
@@ -51,6 +58,38 @@ class ChatMessage(BaseModel):
     role: str
     content: str
     timestamp: Optional[datetime] = None
+    truncated: Optional[bool] = False
     
     class Config:
         from_attributes = True
+
+class UploadResult(BaseModel):
+    filename: str
+    url: str
+    deduplicated: bool = False # Same content was already stored, nothing was uploaded
+
+class UploadCheck(BaseModel):
+    sha256: str = Field(pattern="^[0-9a-fA-F]{64}$")
+    filename: Optional[str] = None
+
+class UploadPresign(BaseModel):
+    filename: str
+    size: int = Field(gt=0)
+    content_type: Optional[str] = None
+    sha256: Optional[str] = Field(default=None, pattern="^[0-9a-fA-F]{64}$")
+
+class UploadPart(BaseModel):
+    part_number: int = Field(ge=1)
+    etag: str
+
+class UploadComplete(BaseModel):
+    object_key: str
+    filename: str
+    upload_id: Optional[str] = None # Set for multipart uploads
+    parts: List[UploadPart] = []
+    content_type: Optional[str] = None
+    sha256: Optional[str] = Field(default=None, pattern="^[0-9a-fA-F]{64}$")
+
+class UploadAbort(BaseModel):
+    object_key: str
+    upload_id: str
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from fastapi import HTTPException, status
+from config import settings
+from .metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger("RealEgo")
+
+admission_active = Gauge("realego_llm_admission_active", "LLM requests (chat turns, voice recordings) holding a slot")
+admission_waiting = Gauge("realego_llm_admission_waiting", "LLM requests queued for a slot")
+admission_wait_seconds = Histogram("realego_llm_admission_wait_seconds", "Time from arrival to admission")
+admission_rejected_total = Counter(
+    "realego_llm_admission_rejected_total",
+    "LLM requests answered with 429 (queue_full, user_limit = too many of the user's own in flight or queued, timeout)",
+    labelnames=("reason",),
+)
+
+class AdmissionTicket:
+    """A held slot. release() is idempotent, so it can be tied to several exit paths."""
+    def __init__(self, controller, user_id: int):
+        self._controller = controller
+        self.user_id = user_id
+        self.admitted_at = time.perf_counter()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self)
+
+class AdmissionController:
+    """
+    Bounds concurrent upstream LLM work: at most LLM_MAX_CONCURRENT requests
+    in flight and LLM_MAX_CONCURRENT_PER_USER per user. Requests over either
+    limit wait in a FIFO queue of at most LLM_MAX_WAITING, and a waiter is
+    admitted as soon as a slot its user may take frees up; one held back by
+    its own user's limit never delays other users while global slots are
+    free. When the queue is full, a user already has as many requests queued
+    as in flight, or the wait exceeds LLM_ADMISSION_TIMEOUT, the caller gets
+    a 429 with a Retry-After estimated from recent slot hold times, instead
+    of every user slowing down together. Limits are per process.
+    """
+    def __init__(self):
+        self.active = 0
+        self._per_user = {} # user_id -> slots held
+        self._queued = {} # user_id -> waiters
+        self._waiters = deque() # (user_id, future), oldest first
+        self._hold_seconds = 10.0 # Moving average of how long a slot is held
+
+    def _can_run(self, user_id: int) -> bool:
+        return (self.active < settings.LLM_MAX_CONCURRENT
+                and self._per_user.get(user_id, 0) < settings.LLM_MAX_CONCURRENT_PER_USER)
+
+    def _admit(self, user_id: int) -> AdmissionTicket:
+        self.active += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        admission_active.inc()
+        return AdmissionTicket(self, user_id)
+
+    def retry_after(self) -> int:
+        """Seconds until the queue has likely drained, for the Retry-After header."""
+        rounds = (len(self._waiters) + 1) / max(settings.LLM_MAX_CONCURRENT, 1)
+        return min(max(math.ceil(rounds * self._hold_seconds), 1), 60)
+
+    def _reject(self, reason: str, user_id: int):
+        admission_rejected_total.inc(reason=reason)
+        retry_after = self.retry_after()
+        logger.warning(f"LLM admission rejected for user {user_id} ({reason}; {self.active} active, {len(self._waiters)} waiting)")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests in progress, please retry shortly",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    async def acquire(self, user_id: int) -> AdmissionTicket:
+        """Wait for a slot (or raise the 429 HTTPException). Call release() on the ticket when done."""
+        start = time.perf_counter()
+        # Waiters that can run go first; the ones left are blocked on their own
+        # user's limit, so they must not hold up other users while slots are free
+        self._wake()
+        if self._can_run(user_id):
+            admission_wait_seconds.observe(0)
+            return self._admit(user_id)
+        if len(self._waiters) >= settings.LLM_MAX_WAITING:
+            self._reject("queue_full", user_id)
+        if self._queued.get(user_id, 0) >= settings.LLM_MAX_CONCURRENT_PER_USER:
+            self._reject("user_limit", user_id)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (user_id, future)
+        self._waiters.append(entry)
+        self._queued[user_id] = self._queued.get(user_id, 0) + 1
+        admission_waiting.inc()
+        self._wake()
+        try:
+            ticket = await asyncio.wait_for(asyncio.shield(future), settings.LLM_ADMISSION_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Admitted just as we gave up: hand the slot back
+                future.result().release()
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject("timeout", user_id)
+        finally:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+            self._queued[user_id] -= 1
+            if not self._queued[user_id]:
+                del self._queued[user_id]
+            admission_waiting.dec()
+        admission_wait_seconds.observe(time.perf_counter() - start)
+        return ticket
+
+    def _release(self, ticket: AdmissionTicket):
+        self.active -= 1
+        self._per_user[ticket.user_id] -= 1
+        if not self._per_user[ticket.user_id]:
+            del self._per_user[ticket.user_id]
+        admission_active.dec()
+        self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * (time.perf_counter() - ticket.admitted_at)
+        self._wake()
+
+    def _wake(self):
+        # Admit the oldest waiters whose user is under the limit; others keep their place
+        for entry in list(self._waiters):
+            if self.active >= settings.LLM_MAX_CONCURRENT:
+                break
+            user_id, future = entry
+            if not future.done() and self._can_run(user_id):
+                self._waiters.remove(entry)
+                future.set_result(self._admit(user_id))
+
+llm_admission = AdmissionController()
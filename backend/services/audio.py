@@ -0,0 +1,72 @@
+import asyncio
+import glob
+import logging
+import os
+import shutil
+import tempfile
+from config import settings
+
+logger = logging.getLogger("RealEgo")
+
+class AudioSegments:
+    """
+    A recording cut into fixed-length 16 kHz mono WAV segments by ffmpeg, in a
+    temporary directory that is removed on close(). Without ffmpeg (or if it
+    cannot decode the input) the original file is kept as a single segment.
+    """
+    def __init__(self, workdir: str, paths: list):
+        self.workdir = workdir
+        self.paths = paths
+
+    def read(self, index: int):
+        """(filename, bytes) of one segment, in the form the transcription API accepts."""
+        path = self.paths[index]
+        with open(path, "rb") as f:
+            return os.path.basename(path), f.read()
+
+    def close(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+def _copy_to(fileobj, path: str):
+    fileobj.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(fileobj, out, 1024 * 1024)
+
+async def save_audio(audio_file, filename: str) -> AudioSegments:
+    """
+    Copy an uploaded recording (a sync file object, e.g. UploadFile.file) to a
+    temporary directory, as a single segment until split_audio runs. Done in the
+    request handler, since the upload is closed once a streaming response starts.
+    """
+    workdir = tempfile.mkdtemp(prefix="realego-voice-")
+    ext = os.path.splitext(filename or "")[1] or ".webm"
+    source = os.path.join(workdir, "source" + ext)
+    await asyncio.to_thread(_copy_to, audio_file, source)
+    return AudioSegments(workdir, [source])
+
+async def split_audio(segments: AudioSegments):
+    """Cut the saved recording into VOICE_SEGMENT_SECONDS windows in place."""
+    source = segments.paths[0]
+    ffmpeg = shutil.which(settings.FFMPEG_PATH)
+    if not ffmpeg:
+        logger.warning("ffmpeg not found, transcribing the recording as one segment")
+        return
+
+    proc = await asyncio.create_subprocess_exec(
+        ffmpeg, "-nostdin", "-loglevel", "error", "-i", source,
+        "-ac", "1", "-ar", "16000",
+        "-f", "segment", "-segment_time", str(settings.VOICE_SEGMENT_SECONDS),
+        os.path.join(segments.workdir, "segment_%04d.wav"),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    paths = sorted(glob.glob(os.path.join(segments.workdir, "segment_*.wav")))
+    if proc.returncode != 0 or not paths:
+        logger.warning(f"ffmpeg could not segment {os.path.basename(source)} (exit {proc.returncode}): {stderr.decode(errors='replace')[:500]}")
+        return
+    segments.paths = paths
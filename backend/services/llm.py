@@ -1,10 +1,23 @@
 from openai import AsyncOpenAI
 from config import settings
-from .mem0 import mem0_service
+from .turn import TurnContext, chat_errors_total
+from .audio import AudioSegments, split_audio
+from .timeline import CATEGORIES, route_categories, merge_update
+from .prompt import prompt_builder
+from .metrics import Histogram
+import asyncio
+import json
 import logging
+from logging_config import log_payload
 
 logger = logging.getLogger("RealEgo")
 
+voice_stage_seconds = Histogram(
+    "realego_voice_stage_seconds",
+    "Duration of voice profile steps (split, transcribe per segment, extract per batch)",
+    labelnames=("stage",),
+)
+
 class LLMService:
     def __init__(self):
         try:
@@ -17,134 +30,197 @@ class LLMService:
             self.client = None
         self.model = settings.ARK_MODEL
 
-    async def chat(self, message: str, user_id: str, user_profile: dict, stream: bool = False):
+    async def chat_with_context(self, context: TurnContext, stream: bool = False):
+        """Call the LLM using the profile and memories already gathered in context."""
         if not self.client:
             logger.error("LLM Service not available (Configuration missing).")
             return "LLM Service not available (Configuration missing)."
         
-        logger.debug(f"Starting LLM chat for user {user_id}")
+        message = context.message
+        logger.debug(f"Starting LLM chat for user {context.user_id}")
 
-        # 1. Search relevant memories (Async)
-        memories = await mem0_service.search_memory(message, user_id)
-        
-        # 2. Construct system prompt with profile and memories
-        system_prompt = f"You are a helpful assistant for {user_profile.get('username', 'User')}."
-        
-        profile_text = "User Profile:\n"
-        if user_profile.get('full_name'): profile_text += f"Name: {user_profile['full_name']}\n"
-        if user_profile.get('birth_date'): profile_text += f"Birth Date: {user_profile['birth_date']}\n"
-        if user_profile.get('location'): profile_text += f"Location: {user_profile['location']}\n"
-        # ... add more fields
-        
-        memory_text = "Relevant Memories:\n"
-        if memories:
-            for mem in memories:
-                # Assuming mem structure, adjust as needed
-                # mem0 usually returns list of dicts with 'memory' key
-                mem_content = mem.get('memory', mem) if isinstance(mem, dict) else mem
-                memory_text += f"- {mem_content}\n"
-        
-        system_prompt += f"\n\n{profile_text}\n\n{memory_text}"
-        
-        logger.debug(f"Constructed System Prompt: {system_prompt}")
-        logger.debug(f"User Message: {message}")
-        
-        # 3. Call LLM
+        # Profile, memories and history packed into PROMPT_TOKEN_BUDGET
+        messages, context.prompt_tokens = prompt_builder.build(context)
+        system_prompt = messages[0]["content"]
+
+        # Call LLM
         try:
-            logger.info(f"--- LLM REQUEST START ---")
-            logger.info(f"Model: {self.model}")
-            logger.info(f"System Prompt: {system_prompt}")
-            logger.info(f"User Message: {message}")
-            logger.info(f"--- LLM REQUEST END ---")
+            logger.info(f"LLM request: model={self.model} user={context.user_id} history_messages={len(messages) - 2}/{len(context.history)} prompt_tokens={context.prompt_tokens}")
+            log_payload(logger, "System Prompt", system_prompt)
+            log_payload(logger, "User Message", message)
 
             if stream:
                 completion = await self.client.chat.completions.create(
                     model=self.model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": message}
-                    ],
+                    messages=messages,
                     stream=True
                 )
                 return completion
             else:
                 completion = await self.client.chat.completions.create(
                     model=self.model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": message}
-                    ]
+                    messages=messages
                 )
                 response = completion.choices[0].message.content
                 
-                logger.info(f"--- LLM RESPONSE START ---")
-                logger.info(f"Response Content: {response}")
-                logger.info(f"--- LLM RESPONSE END ---")
+                log_payload(logger, "LLM Response", response)
                 
                 return response
         except Exception as e:
             logger.error(f"LLM Error: {e}", exc_info=True)
             return "Sorry, I encountered an error processing your request."
 
-    async def process_voice_profile(self, audio_file, current_timeline: dict):
+    async def summarize_conversation(self, previous_summary: str, messages: list) -> str:
+        """
+        Fold messages ([{"role": ..., "content": ...}], oldest first) into the
+        running summary of the conversation and return the new summary. Raises
+        on failure, so the caller keeps the previous summary.
+        """
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        summary_prompt = f"""
+        Update the running summary of a conversation between a user and their assistant.
+        Keep the facts, events, people, preferences and open threads that later turns may
+        refer back to; drop greetings and small talk. Write in the language of the conversation,
+        at most {settings.SUMMARY_MAX_TOKENS} tokens.
+
+        Current Summary: {previous_summary or "(none yet)"}
+
+        New Messages:
+        {transcript}
+
+        Return ONLY the updated summary.
+        """
+        completion = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "You are a concise conversation summarizer."},
+                {"role": "user", "content": summary_prompt}
+            ],
+            max_tokens=settings.SUMMARY_MAX_TOKENS * 2,
+        )
+        summary = (completion.choices[0].message.content or "").strip()
+        if not summary:
+            raise ValueError("LLM returned an empty summary")
+        return summary
+
+    async def transcribe(self, audio) -> str:
+        """audio: a file object or a (filename, bytes) tuple."""
+        # Note: Ensure the model supports transcription or use specific whisper endpoint
+        transcription = await self.client.audio.transcriptions.create(
+            model="whisper-1", # Often standard alias
+            file=audio
+        )
+        return transcription.text
+
+    async def extract_timeline(self, text: str, current_timeline: dict) -> str:
         """
-        1. Transcribe audio
-        2. Extract structured profile data
-        3. Merge with current timeline
+        Extract timeline categories mentioned in text. current_timeline may hold
+        only the categories the text is about (see timeline.route_categories).
+        Returns the LLM's JSON string.
+        """
+        category_lines = "\n".join(f"{i}: {description}" for i, (description, _) in enumerate(CATEGORIES.values()))
+        category_keys = ", ".join(f'"{key}"' for key in CATEGORIES)
+        extraction_prompt = f"""
+        You are a data extraction assistant.
+        Extract information from the user's spoken input into the following JSON structure.
+        Only update fields that are mentioned. Keep existing data if not contradicted.
+        
+        Categories:
+        {category_lines}
+        
+        Current Data: {current_timeline}
+        
+        User Input: "{text}"
+        
+        Return ONLY the updated JSON, with only the categories the input mentions. Keys must be among: 
+        {category_keys}.
+        Each value should be a string or object with details, including the existing details it keeps.
+        """
+        
+        completion = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "You are a precise data extractor. Output JSON only."},
+                {"role": "user", "content": extraction_prompt}
+            ],
+            response_format={ "type": "json_object" } # If supported, else prompt engineering
+        )
+        return completion.choices[0].message.content
+
+    async def process_voice_profile_stream(self, segments: AudioSegments, current_timeline: dict):
+        """
+        Incremental voice profile pipeline. Splits the saved recording into
+        windows, transcribes them concurrently (VOICE_TRANSCRIBE_CONCURRENCY)
+        and extracts in recording order: each extraction covers every transcript
+        finished since the previous one, so it overlaps the remaining
+        transcriptions. Yields events like the chat stream:
+        - {"type": "log" | "error", "content": str}
+        - {"type": "transcript", "segments": [first, last], "content": str}
+        - {"type": "timeline", "content": {category: value}} categories changed by that transcript
+        Always removes the segment files when done.
         """
         if not self.client:
-            return None, "LLM Service not available"
+            segments.close()
+            yield {"type": "error", "content": "LLM Service not available"}
+            return
 
+        timeline = dict(current_timeline)
+        tasks = []
         try:
-            # 1. Transcribe
-            # Note: Ensure the model supports transcription or use specific whisper endpoint
-            
-            transcription = await self.client.audio.transcriptions.create(
-                model="whisper-1", # Often standard alias
-                file=audio_file
-            )
-            text = transcription.text
-            logger.info(f"Transcribed text: {text}")
-
-            # 2. Extract Info
-            extraction_prompt = f"""
-            You are a data extraction assistant.
-            Extract information from the user's spoken input into the following JSON structure.
-            Only update fields that are mentioned. Keep existing data if not contradicted.
-            
-            Categories:
-            0: Birth (Time, Location, etc.)
-            1: 0-6 years old experiences
-            2: Primary/Secondary Education & Events
-            3: Higher Education & Events
-            4: Family Relations
-            5: Social Relations (Friends)
-            6: Work History
-            7: Locations (Residence, Work, Past)
-            8: Assets
-            
-            Current Data: {current_timeline}
-            
-            User Input: "{text}"
-            
-            Return ONLY the updated JSON. Keys must be: 
-            "0_birth", "1_early_childhood", "2_primary_edu", "3_higher_edu", "4_family", "5_social", "6_work", "7_locations", "8_assets".
-            Each value should be a string or object with details.
-            """
-            
-            completion = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a precise data extractor. Output JSON only."},
-                    {"role": "user", "content": extraction_prompt}
-                ],
-                response_format={ "type": "json_object" } # If supported, else prompt engineering
-            )
-            json_response = completion.choices[0].message.content
-            return text, json_response
+            yield {"type": "log", "content": "Splitting audio..."}
+            with voice_stage_seconds.time(stage="split"):
+                await split_audio(segments)
+            count = len(segments.paths)
+            yield {"type": "log", "content": f"Transcribing {count} segments..."}
 
-        except Exception as e:
-            logger.error(f"Voice processing error: {e}", exc_info=True)
-            return None, str(e)
+            slots = asyncio.Semaphore(settings.VOICE_TRANSCRIBE_CONCURRENCY)
+            async def transcribe_segment(index):
+                async with slots:
+                    audio = await asyncio.to_thread(segments.read, index)
+                    with voice_stage_seconds.time(stage="transcribe"):
+                        return await self.transcribe(audio)
+            tasks = [asyncio.create_task(transcribe_segment(i)) for i in range(count)]
+
+            next_index = 0
+            while next_index < count:
+                await asyncio.wait([tasks[next_index]])
+                batch_end = next_index + 1
+                while batch_end < count and tasks[batch_end].done():
+                    batch_end += 1
+
+                texts = []
+                for i in range(next_index, batch_end):
+                    if tasks[i].exception():
+                        chat_errors_total.inc(stage="voice_transcribe")
+                        logger.error(f"Transcribing segment {i} failed: {tasks[i].exception()!r}")
+                        yield {"type": "error", "content": f"Segment {i + 1} could not be transcribed."}
+                    elif tasks[i].result():
+                        texts.append(tasks[i].result())
+                text = " ".join(texts)
+                yield {"type": "transcript", "segments": [next_index, batch_end - 1], "content": text}
+                next_index = batch_end
+                if not text.strip():
+                    continue
+
+                log_payload(logger, "Transcribed text", text)
+                # Only the categories this transcript is about go into the prompt
+                categories = route_categories(text) or list(CATEGORIES)
+                relevant = {key: timeline[key] for key in categories if key in timeline}
+                try:
+                    with voice_stage_seconds.time(stage="extract"):
+                        update = json.loads(await self.extract_timeline(text, relevant))
+                    if not isinstance(update, dict):
+                        raise ValueError(f"Expected a JSON object, got {type(update).__name__}")
+                except Exception as e:
+                    chat_errors_total.inc(stage="voice_extract")
+                    logger.error(f"Timeline extraction failed: {e!r}")
+                    yield {"type": "error", "content": f"Could not extract profile data: {e}"}
+                    continue
+                yield {"type": "timeline", "content": merge_update(timeline, update, categories)}
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            segments.close()
 
 llm_service = LLMService()
@@ -1,49 +1,144 @@
-from mem0 import MemoryClient
 from config import settings
 import logging
 import asyncio
-from functools import partial
+import time
+import httpx
+from collections import OrderedDict
+
+try:
+    import h2 # noqa: F401 - enables HTTP/2 in httpx when installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 logger = logging.getLogger("RealEgo")
 
+def normalize_query(query: str) -> str:
+    # Case and whitespace differences should not cause a cache miss
+    return " ".join(query.lower().split())
+
+class AsyncMem0Client:
+    """
+    Native async client for the Mem0 REST API (the calls test_mem0.py makes
+    through the synchronous MemoryClient), sharing one pooled keep-alive
+    httpx.AsyncClient instead of a thread per request.
+    """
+    def __init__(self, host: str, api_key: str):
+        self.host = host
+        self.api_key = api_key
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Created lazily so it binds to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.host,
+                headers={"Authorization": f"Token {self.api_key}"},
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(settings.MEM0_TIMEOUT, connect=settings.MEM0_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=settings.MEM0_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.MEM0_MAX_CONNECTIONS,
+                ),
+            )
+        return self._client
+
+    async def _request(self, method: str, path: str, **kwargs):
+        response = await self._get_client().request(method, path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    async def add(self, messages: list, user_id: str, async_mode: bool = True):
+        payload = {"messages": messages, "user_id": user_id, "async_mode": async_mode, "output_format": "v1.1"}
+        return await self._request("POST", "/v1/memories/", json=payload)
+
+    async def search(self, query: str, user_id: str):
+        payload = {"query": query, "user_id": user_id, "output_format": "v1.1"}
+        return await self._request("POST", "/v1/memories/search/", json=payload)
+
+    async def get_all(self, user_id: str):
+        return await self._request("GET", "/v1/memories/", params={"user_id": user_id, "output_format": "v1.1"})
+
+    async def delete(self, memory_id: str):
+        return await self._request("DELETE", f"/v1/memories/{memory_id}/")
+
+    async def get_job(self, event_id: str):
+        """Status of an async_mode add, as polled by check_job_status in test_mem0.py."""
+        return await self._request("GET", f"/v1/job/{event_id}/")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
 class Mem0Service:
     def __init__(self):
-        self.client = MemoryClient(
-            host=settings.MEM0_API_URL,
-            api_key=settings.MEM0_API_KEY
-        )
+        self.client = AsyncMem0Client(settings.MEM0_API_URL, settings.MEM0_API_KEY)
+        self._search_slots = asyncio.Semaphore(settings.MEM0_SEARCH_CONCURRENCY)
+        self._write_slots = asyncio.Semaphore(settings.MEM0_WRITE_CONCURRENCY)
+        # (user_id, normalized query) -> (expires_at, results), oldest first
+        self._search_cache = OrderedDict()
 
-    async def add_memory(self, messages: list, user_id: str):
-        """
-        Add memory asynchronously (non-blocking for the event loop).
-        messages: List of dicts, e.g. [{"role": "user", "content": "..."}, ...]
-        """
-        loop = asyncio.get_running_loop()
-        try:
-            # async_mode=True tells the Mem0 server to process this as a background job
-            func = partial(self.client.add, messages, user_id=user_id, async_mode=True)
-            result = await loop.run_in_executor(None, func)
-            logger.info(f"Memory add job submitted: {result}")
-            return result
-        except Exception as e:
-            logger.error(f"Error adding memory: {e}")
+    def _cache_get(self, key):
+        entry = self._search_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, results = entry
+        if expires_at < time.monotonic():
+            del self._search_cache[key]
             return None
+        self._search_cache.move_to_end(key)
+        return results
+
+    def _cache_put(self, key, results):
+        if settings.MEM0_SEARCH_CACHE_TTL <= 0:
+            return
+        self._search_cache[key] = (time.monotonic() + settings.MEM0_SEARCH_CACHE_TTL, results)
+        self._search_cache.move_to_end(key)
+        while len(self._search_cache) > settings.MEM0_SEARCH_CACHE_SIZE:
+            self._search_cache.popitem(last=False)
+
+    def invalidate_user(self, user_id: str):
+        """Drop cached search results for a user, e.g. after new memories were added."""
+        for key in [k for k in self._search_cache if k[0] == user_id]:
+            del self._search_cache[key]
+
+    async def submit_memory(self, messages: list, user_id: str):
+        """Submit messages as an async Mem0 add job. Raises on failure, so the memory queue can retry."""
+        # async_mode=True tells the Mem0 server to process this as a background job
+        async with self._write_slots:
+            result = await self.client.add(messages, user_id=user_id, async_mode=True)
+        logger.info(f"Memory add job submitted: {result}")
+        self.invalidate_user(user_id)
+        return result
 
     async def search_memory(self, query: str, user_id: str):
         """
-        Search memory asynchronously (non-blocking for the event loop).
-        Returns a list of memory items.
+        Search memory asynchronously.
+        Returns a list of memory items. Results are cached per user for
+        MEM0_SEARCH_CACHE_TTL seconds so retries and rapid follow-ups skip Mem0.
         """
-        loop = asyncio.get_running_loop()
+        cache_key = (user_id, normalize_query(query))
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            logger.debug(f"Memory search cache hit for user {user_id}")
+            return cached
+
         try:
-            func = partial(self.client.search, query, user_id=user_id)
-            result = await loop.run_in_executor(None, func)
+            async with self._search_slots:
+                result = await self.client.search(query, user_id=user_id)
             # Ensure we return a list. result is typically {'results': [...]}
             if isinstance(result, dict):
-                return result.get("results", [])
-            return result if isinstance(result, list) else []
+                results = result.get("results", [])
+            else:
+                results = result if isinstance(result, list) else []
+            self._cache_put(cache_key, results)
+            return results
         except Exception as e:
-            logger.error(f"Error searching memory: {e}")
+            logger.error(f"Error searching memory: {e!r}")
             return []
 
+    async def close(self):
+        await self.client.aclose()
+
 mem0_service = Mem0Service()
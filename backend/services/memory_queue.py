@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete
+import database, models
+from config import settings
+from .mem0 import mem0_service
+from .turn import chat_stage_seconds, chat_errors_total
+
+logger = logging.getLogger("RealEgo")
+
+Outbox = models.MemoryOutbox
+
+def _job_event_id(result):
+    # async_mode adds answer {"results": [{"event_id": ..., "status": "PENDING"}]}
+    if isinstance(result, dict):
+        for item in result.get("results") or []:
+            if isinstance(item, dict) and item.get("event_id"):
+                return item["event_id"]
+    return None
+
+def _backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(settings.MEMORY_QUEUE_RETRY_BASE * 2 ** (attempts - 1), settings.MEMORY_QUEUE_RETRY_MAX))
+
+def _max_batches_per_pass() -> int:
+    # Rounds of MEM0_WRITE_CONCURRENCY add calls that fit in the lease, each allowed twice the client timeouts
+    call_seconds = 2 * (settings.MEM0_CONNECT_TIMEOUT + settings.MEM0_TIMEOUT)
+    return max(int(settings.MEMORY_QUEUE_LEASE // call_seconds), 1) * max(settings.MEM0_WRITE_CONCURRENCY, 1)
+
+class MemoryIngestQueue:
+    """
+    Durable write-behind queue for Mem0 ingestion.
+
+    Chat turns are written to the memory_outbox table and a background worker
+    submits them to Mem0, merging all queued turns of a user into one add call,
+    retrying failures with exponential backoff and polling each async job until
+    Mem0 reports it finished. Rows are claimed with SELECT ... FOR UPDATE SKIP
+    LOCKED and a lease (next_attempt_at), so several worker processes can share
+    the table and rows claimed by a crashed process are picked up again.
+    A pass submits its batches concurrently and claims no more of them than
+    it can submit before the lease runs out.
+    """
+    def __init__(self):
+        self._task = None
+
+    async def enqueue(self, db, messages: list, user_id: int):
+        # Held for MEMORY_QUEUE_BATCH_DELAY so rapid follow-up turns share one Mem0 call
+        db.add(Outbox(
+            user_id=user_id,
+            messages=json.dumps(messages, ensure_ascii=False),
+            status="pending",
+            next_attempt_at=datetime.utcnow() + timedelta(seconds=settings.MEMORY_QUEUE_BATCH_DELAY),
+        ))
+        await db.commit()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        logger.info("Memory queue worker started.")
+        while True:
+            try:
+                await self.process_pending()
+                await self.poll_jobs()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Memory queue worker error: {e!r}")
+            await asyncio.sleep(settings.MEMORY_QUEUE_POLL_INTERVAL)
+
+    async def process_pending(self):
+        """Submit every due batch once. Returns the number of Mem0 add calls made."""
+        batches = await self._claim_pending()
+        # Concurrently, up to MEM0_WRITE_CONCURRENCY calls in flight (Mem0Service._write_slots)
+        results = await asyncio.gather(*(self._submit(user_id, rows) for user_id, rows in batches.items()), return_exceptions=True)
+        for user_id, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.error(f"Recording the memory batch of user {user_id} failed: {result!r}")
+        return len(batches)
+
+    async def _claim_pending(self):
+        now = datetime.utcnow()
+        async with database.AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Outbox)
+                .where(Outbox.status.in_(("pending", "submitting")), Outbox.next_attempt_at <= now)
+                .order_by(Outbox.id)
+                .limit(settings.MEMORY_QUEUE_BATCH_ROWS)
+                .with_for_update(skip_locked=True)
+            )
+            rows = list(result.scalars().all())
+            if not rows:
+                return {}
+            # Fresh turns of the same users ride along even if their batch delay has not passed yet
+            result = await db.execute(
+                select(Outbox)
+                .where(
+                    Outbox.user_id.in_({row.user_id for row in rows}),
+                    Outbox.status == "pending",
+                    Outbox.attempts == 0,
+                    Outbox.id.notin_([row.id for row in rows]),
+                )
+                .with_for_update(skip_locked=True)
+            )
+            rows += result.scalars().all()
+
+            # Only as many batches as one pass surely submits within the lease; if the lease ran
+            # out mid-pass another worker would claim the same rows and Mem0 would get them twice
+            max_batches = _max_batches_per_pass()
+            batches = {}
+            for row in sorted(rows, key=lambda r: r.id):
+                if row.user_id not in batches and len(batches) >= max_batches:
+                    continue
+                user_rows = batches.setdefault(row.user_id, [])
+                if len(user_rows) < settings.MEMORY_QUEUE_MAX_TURNS_PER_CALL:
+                    user_rows.append(row)
+
+            lease_until = now + timedelta(seconds=settings.MEMORY_QUEUE_LEASE)
+            claimed = {}
+            for user_id, user_rows in batches.items():
+                for row in user_rows:
+                    row.status = "submitting"
+                    row.next_attempt_at = lease_until
+                claimed[user_id] = [(row.id, json.loads(row.messages), row.attempts) for row in user_rows]
+            await db.commit()
+        return claimed
+
+    async def _submit(self, user_id: int, rows: list):
+        ids = [row_id for row_id, _, _ in rows]
+        messages = [m for _, row_messages, _ in rows for m in row_messages]
+        try:
+            with chat_stage_seconds.time(stage="memory_add"):
+                result = await mem0_service.submit_memory(messages, str(user_id))
+        except Exception as e:
+            chat_errors_total.inc(stage="memory_add")
+            logger.warning(f"Memory batch for user {user_id} ({len(ids)} turns) failed: {e!r}")
+            async with database.AsyncSessionLocal() as db:
+                await self._retry_later(db, ids, max(attempts for _, _, attempts in rows) + 1, repr(e))
+                await db.commit()
+            return
+
+        event_id = _job_event_id(result)
+        now = datetime.utcnow()
+        async with database.AsyncSessionLocal() as db:
+            if event_id:
+                await db.execute(update(Outbox).where(Outbox.id.in_(ids)).values(
+                    status="submitted",
+                    event_id=event_id,
+                    submitted_at=now,
+                    next_attempt_at=now + timedelta(seconds=settings.MEMORY_QUEUE_JOB_POLL_INTERVAL),
+                ))
+            else:
+                # Processed synchronously, nothing to track
+                await db.execute(delete(Outbox).where(Outbox.id.in_(ids)))
+            await db.commit()
+
+    async def poll_jobs(self):
+        """Check submitted Mem0 jobs; finished ones leave the queue, failed ones are retried."""
+        now = datetime.utcnow()
+        async with database.AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Outbox)
+                .where(Outbox.status == "submitted", Outbox.next_attempt_at <= now)
+                .order_by(Outbox.id)
+                .limit(settings.MEMORY_QUEUE_BATCH_ROWS)
+                .with_for_update(skip_locked=True)
+            )
+            jobs = {}
+            for row in result.scalars().all():
+                row.next_attempt_at = now + timedelta(seconds=settings.MEMORY_QUEUE_LEASE)
+                job = jobs.setdefault(row.event_id, {"ids": [], "attempts": 0, "submitted_at": row.submitted_at})
+                job["ids"].append(row.id)
+                job["attempts"] = max(job["attempts"], row.attempts)
+            await db.commit()
+
+        for event_id, job in jobs.items():
+            status, error = None, None
+            try:
+                status = (await mem0_service.client.get_job(event_id)).get("status")
+            except Exception as e:
+                error = repr(e)
+            async with database.AsyncSessionLocal() as db:
+                ids = job["ids"]
+                if status == "SUCCEEDED":
+                    await db.execute(delete(Outbox).where(Outbox.id.in_(ids)))
+                elif status == "FAILED":
+                    chat_errors_total.inc(stage="memory_add")
+                    await self._retry_later(db, ids, job["attempts"] + 1, f"Mem0 job {event_id} failed")
+                elif job["submitted_at"] and job["submitted_at"] < now - timedelta(seconds=settings.MEMORY_QUEUE_JOB_TIMEOUT):
+                    logger.warning(f"Giving up tracking Mem0 job {event_id} (last status {status or error})")
+                    await db.execute(delete(Outbox).where(Outbox.id.in_(ids)))
+                else:
+                    await db.execute(update(Outbox).where(Outbox.id.in_(ids)).values(
+                        next_attempt_at=datetime.utcnow() + timedelta(seconds=settings.MEMORY_QUEUE_JOB_POLL_INTERVAL),
+                        last_error=error,
+                    ))
+                await db.commit()
+
+    async def _retry_later(self, db, ids: list, attempts: int, error: str):
+        if attempts >= settings.MEMORY_QUEUE_MAX_ATTEMPTS:
+            logger.error(f"Memory outbox rows {ids} failed {attempts} times, giving up: {error}")
+            values = dict(status="failed", attempts=attempts, last_error=error)
+        else:
+            values = dict(
+                status="pending",
+                attempts=attempts,
+                last_error=error,
+                event_id=None,
+                next_attempt_at=datetime.utcnow() + _backoff(attempts),
+            )
+        await db.execute(update(Outbox).where(Outbox.id.in_(ids)).values(**values))
+
+memory_queue = MemoryIngestQueue()
@@ -0,0 +1,113 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond pool waits up to slow remote calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY = []
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+class Gauge(Counter):
+    """A value that goes up and down, e.g. work currently in flight."""
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram:
+    """Cumulative bucket histogram. Thread-safe, since sync DB code runs in worker threads."""
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the with-block, even if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """Return {label values: {"buckets": {le: count}, "sum": float, "count": int}}."""
+        with self._lock:
+            return {
+                key: {
+                    "buckets": dict(zip(self.buckets, state[:len(self.buckets)])),
+                    "sum": state[-2],
+                    "count": state[-1],
+                }
+                for key, state in self._values.items()
+            }
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+def render_prometheus() -> str:
+    """Render every registered metric in the Prometheus text exposition format (0.0.4)."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        if isinstance(metric, Histogram):
+            lines.append(f"# TYPE {metric.name} histogram")
+            for key, state in sorted(metric.snapshot().items()):
+                for bound, count in state["buckets"].items():
+                    lines.append(f"{metric.name}_bucket{_format_labels(metric.labelnames, key, [('le', bound)])} {count}")
+                lines.append(f"{metric.name}_bucket{_format_labels(metric.labelnames, key, [('le', '+Inf')])} {state['count']}")
+                lines.append(f"{metric.name}_sum{_format_labels(metric.labelnames, key)} {state['sum']}")
+                lines.append(f"{metric.name}_count{_format_labels(metric.labelnames, key)} {state['count']}")
+        else:
+            kind = "gauge" if isinstance(metric, Gauge) else "counter"
+            lines.append(f"# TYPE {metric.name} {kind}")
+            for key, value in sorted(metric.snapshot().items()):
+                lines.append(f"{metric.name}{_format_labels(metric.labelnames, key)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,171 @@
+import logging
+import re
+from config import settings
+from .metrics import Counter, Histogram
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception: # Not installed, or the encoding could not be loaded (offline)
+    _encoding = None
+
+logger = logging.getLogger("RealEgo")
+
+prompt_tokens = Histogram(
+    "realego_prompt_tokens",
+    "Prompt tokens per chat turn by section (system, profile, summary, memories, history, message, total)",
+    labelnames=("section",),
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384),
+)
+prompt_dropped_total = Counter(
+    "realego_prompt_dropped_total",
+    "Memories and history messages left out of the prompt to stay within PROMPT_TOKEN_BUDGET",
+    labelnames=("section",),
+)
+
+# Per-message overhead of the chat format (role, separators), as counted by OpenAI-style tokenizers
+MESSAGE_OVERHEAD = 4
+
+_CJK = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+def count_tokens(text: str) -> int:
+    """Tokens in text: exact with tiktoken installed, otherwise estimated (CJK ~1 per char, else ~4 chars per token)."""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to at most max_tokens, marking the cut."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text, disallowed_special=())[:max_tokens - 1]) + "…"
+    # Longest prefix whose estimate fits
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens - 1:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "…"
+
+def memory_text(mem) -> str:
+    # mem0 usually returns list of dicts with 'memory' key
+    return str(mem.get("memory", mem) if isinstance(mem, dict) else mem)
+
+def rank_memories(memories: list) -> list:
+    """Highest Mem0 score first, duplicates removed."""
+    seen, ranked = set(), []
+    for mem in sorted(memories, key=lambda m: -(m.get("score") or 0) if isinstance(m, dict) else 0):
+        text = memory_text(mem).strip()
+        if text and text not in seen:
+            seen.add(text)
+            ranked.append(text)
+    return ranked
+
+SUMMARY_HEADER = "\n\nEarlier Conversation (summary):\n"
+
+def format_system_prompt(username: str, profile_lines: list, memory_lines: list, summary: str = "") -> str:
+    system_prompt = f"You are a helpful assistant for {username}."
+    profile_text = "User Profile:\n" + "".join(f"{line}\n" for line in profile_lines)
+    memories_text = "Relevant Memories:\n" + "".join(f"- {line}\n" for line in memory_lines)
+    summary_text = SUMMARY_HEADER + summary if summary else ""
+    return system_prompt + f"\n\n{profile_text}\n\n{memories_text}{summary_text}"
+
+def profile_lines(user_profile: dict) -> list:
+    # In the order they are kept when the profile section has to be cut
+    fields = (("full_name", "Name"), ("birth_date", "Birth Date"), ("location", "Location"), ("family_info", "Family"))
+    return [f"{label}: {user_profile[key]}" for key, label in fields if user_profile.get(key)]
+
+class PromptBuilder:
+    """
+    Assembles the chat messages for a turn within PROMPT_TOKEN_BUDGET.
+
+    The system header and the user's message are always sent. The rest is
+    filled in priority order: profile fields (up to PROMPT_PROFILE_TOKENS),
+    the rolling conversation summary (cut to PROMPT_SUMMARY_TOKENS), memories
+    by Mem0 score (up to PROMPT_MEMORY_TOKENS, each cut to
+    PROMPT_MEMORY_ITEM_TOKENS), then as much of the history after the summary
+    as still fits, newest first. So when space runs out, the oldest history
+    goes first, then the lowest-ranked memories, then summary and profile detail.
+    """
+    def build(self, context) -> tuple:
+        """Returns (messages, {section: tokens})."""
+        budget = settings.PROMPT_TOKEN_BUDGET
+        username = context.profile.get("username", "User")
+        message_tokens = count_tokens(context.message) + MESSAGE_OVERHEAD
+        base_tokens = count_tokens(format_system_prompt(username, [], [])) + MESSAGE_OVERHEAD
+        remaining = budget - message_tokens - base_tokens
+        if remaining < 0:
+            logger.warning(f"Chat message alone exceeds PROMPT_TOKEN_BUDGET ({message_tokens + base_tokens} > {budget} tokens)")
+
+        profile = []
+        profile_budget = min(settings.PROMPT_PROFILE_TOKENS, max(remaining, 0))
+        for line in profile_lines(context.profile):
+            line = truncate_tokens(line, profile_budget - 1)
+            if not line:
+                break
+            profile.append(line)
+            profile_budget -= count_tokens(line) + 1
+        profile_tokens = sum(count_tokens(line) + 1 for line in profile)
+        remaining -= profile_tokens
+
+        summary = ""
+        if context.summary:
+            summary_budget = min(settings.PROMPT_SUMMARY_TOKENS, remaining) - count_tokens(SUMMARY_HEADER)
+            summary = truncate_tokens(context.summary, summary_budget)
+        summary_tokens = count_tokens(SUMMARY_HEADER + summary) if summary else 0
+        remaining -= summary_tokens
+
+        memories = []
+        memory_budget = min(settings.PROMPT_MEMORY_TOKENS, max(remaining, 0))
+        ranked = rank_memories(context.memories)
+        for text in ranked:
+            text = truncate_tokens(text, settings.PROMPT_MEMORY_ITEM_TOKENS)
+            tokens = count_tokens(text) + 2 # "- " prefix and newline
+            if tokens > memory_budget:
+                break
+            memories.append(text)
+            memory_budget -= tokens
+        memory_tokens = sum(count_tokens(text) + 2 for text in memories)
+        remaining -= memory_tokens
+        if len(memories) < len(ranked):
+            prompt_dropped_total.inc(len(ranked) - len(memories), section="memories")
+
+        history = []
+        for msg in reversed(context.history):
+            tokens = count_tokens(msg["content"]) + MESSAGE_OVERHEAD
+            if tokens > remaining:
+                break
+            history.append(msg)
+            remaining -= tokens
+        history.reverse()
+        history_tokens = sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in history)
+        if len(history) < len(context.history):
+            prompt_dropped_total.inc(len(context.history) - len(history), section="history")
+
+        system_prompt = format_system_prompt(username, profile, memories, summary)
+        messages = [{"role": "system", "content": system_prompt}]
+        messages += history
+        messages.append({"role": "user", "content": context.message})
+
+        sections = {
+            "system": base_tokens,
+            "profile": profile_tokens,
+            "summary": summary_tokens,
+            "memories": memory_tokens,
+            "history": history_tokens,
+            "message": message_tokens,
+        }
+        sections["total"] = sum(sections.values())
+        for section, tokens in sections.items():
+            prompt_tokens.observe(tokens, section=section)
+        return messages, sections
+
+prompt_builder = PromptBuilder()
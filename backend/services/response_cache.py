@@ -0,0 +1,95 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from fastapi import Request, Response
+from config import settings
+from .metrics import Counter
+
+response_cache_total = Counter(
+    "realego_response_cache_total",
+    "Cached GET responses by endpoint and result (hit, miss, not_modified)",
+    labelnames=("kind", "result"),
+)
+
+def make_etag(body: bytes) -> str:
+    # Strong validator: identical bytes, identical tag
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so a W/ prefix added by a proxy still matches
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+class ResponseCache:
+    """
+    Per-user data versions plus an LRU of serialized JSON bodies.
+
+    crud bumps a user's version whenever their chat messages or profile change,
+    and bodies are cached under (user_id, kind, version, params), so a write
+    makes every older entry of that user unreachable without scanning the cache.
+    The versions live in this process only: with several worker processes a
+    write is seen by the other workers only once their entry is evicted, so
+    set RESPONSE_CACHE_SIZE=0 when running more than one (manage_server.sh
+    starts a single uvicorn process).
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._versions = {} # user_id -> int
+        self._entries = OrderedDict() # key -> (body, etag), oldest first
+        self._lock = threading.Lock() # crud also runs in sync code (CLI scripts, thread pools)
+
+    def version(self, user_id: int) -> int:
+        return self._versions.get(user_id, 0)
+
+    def bump(self, user_id: int):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def respond(self, request: Request, user_id: int, kind: str, params: tuple, build) -> Response:
+        """
+        Serve a JSON GET from the cache, or call `build()` (an async function
+        returning the serialized body as bytes) on a miss. Answers 304 when the
+        client's If-None-Match already holds the current ETag.
+        """
+        # Read the version before building: a concurrent write then only makes
+        # this entry unreachable, it can never be cached under the newer version
+        key = (user_id, kind, self.version(user_id), params)
+        entry = self._get(key)
+        if entry is None:
+            body = await build()
+            entry = (body, make_etag(body))
+            self._put(key, entry)
+            result = "miss"
+        else:
+            result = "hit"
+        body, etag = entry
+
+        # no-cache: the browser keeps the body but revalidates with If-None-Match every time
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            response_cache_total.inc(kind=kind, result="not_modified")
+            return Response(status_code=304, headers=headers)
+        response_cache_total.inc(kind=kind, result=result)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+response_cache = ResponseCache(settings.RESPONSE_CACHE_SIZE)
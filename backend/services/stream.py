@@ -0,0 +1,124 @@
+import asyncio
+import json
+from config import settings
+from .metrics import Histogram
+
+stream_frame_deltas = Histogram(
+    "realego_chat_stream_frame_deltas",
+    "LLM deltas coalesced into each response_chunk frame",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+# Log lines are mostly constant; ones with counts in them only fill the cache up to this size
+_LOG_CACHE_SIZE = 256
+
+class StreamEncoder:
+    """
+    Encodes chat stream events ({"type": ..., "content": ...}) to bytes, as
+    NDJSON lines, as Server-Sent Events ("data: <json>" blocks) or as bare
+    JSON (one WebSocket frame each). The JSON is the same in every format.
+    The envelope around the content is encoded once, so a response chunk
+    costs one json.dumps of its text.
+    """
+    MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream", "json": "application/json"}
+    FRAMING = {"ndjson": (b"", b"\n"), "sse": (b"data: ", b"\n\n"), "json": (b"", b"")}
+
+    def __init__(self, fmt: str = "ndjson"):
+        self.format = fmt
+        self.media_type = self.MEDIA_TYPES[fmt]
+        self._prefix, self._suffix = self.FRAMING[fmt]
+        self._envelopes = {}
+        self._logs = {}
+
+    def event(self, type: str, content: str) -> bytes:
+        envelope = self._envelopes.get(type)
+        if envelope is None:
+            envelope = self._prefix + json.dumps({"type": type, "content": ""})[:-3].encode()
+            self._envelopes[type] = envelope
+        return envelope + json.dumps(content).encode() + b"}" + self._suffix
+
+    def log(self, content: str) -> bytes:
+        line = self._logs.get(content)
+        if line is None:
+            line = self.event("log", content)
+            if len(self._logs) < _LOG_CACHE_SIZE:
+                self._logs[content] = line
+        return line
+
+    def chunk(self, content: str) -> bytes:
+        return self.event("response_chunk", content)
+
+    def error(self, content: str) -> bytes:
+        return self.event("error", content)
+
+    def wrap(self, frame: bytes) -> bytes:
+        """Frame a bare JSON event (from json_encoder) in this encoder's format."""
+        return self._prefix + frame + self._suffix if self._suffix else frame
+
+# Shared by all turns, so constant log lines are encoded once per process
+json_encoder = StreamEncoder("json")
+
+def stream_format(accept: str) -> str:
+    """SSE when the client asks for text/event-stream, NDJSON otherwise."""
+    return "sse" if accept and "text/event-stream" in accept else "ndjson"
+
+async def coalesce(deltas, window: float = None, max_chars: int = None):
+    """
+    Merge an async iterator of text deltas into larger pieces. The first delta
+    is passed through at once (time to first token is what users notice); after
+    that, deltas are joined until `window` seconds passed since the first one
+    in the buffer or the buffer holds `max_chars`, whichever comes first.
+    window <= 0 passes every delta through unchanged.
+    """
+    window = settings.CHAT_STREAM_FLUSH_MS / 1000 if window is None else window
+    max_chars = settings.CHAT_STREAM_FLUSH_CHARS if max_chars is None else max_chars
+    iterator = deltas.__aiter__()
+    loop = asyncio.get_running_loop()
+    buffer, size, deadline, first = [], 0, 0.0, True
+    pending = None # __anext__ still running when a flush deadline passed
+    try:
+        while True:
+            if not buffer:
+                # Nothing to flush on a timer: wait for the next delta directly, no task needed
+                try:
+                    delta = await (pending if pending is not None else iterator.__anext__())
+                except StopAsyncIteration:
+                    break
+                pending = None
+            else:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait((pending,), timeout=max(deadline - loop.time(), 0))
+                if not done:
+                    stream_frame_deltas.observe(len(buffer))
+                    yield "".join(buffer)
+                    buffer, size = [], 0
+                    continue
+                try:
+                    delta = pending.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    pending = None
+
+            if first or window <= 0:
+                first = False
+                stream_frame_deltas.observe(1)
+                yield delta
+                continue
+            if not buffer:
+                deadline = loop.time() + window
+            buffer.append(delta)
+            size += len(delta)
+            if size >= max_chars:
+                stream_frame_deltas.observe(len(buffer))
+                yield "".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            stream_frame_deltas.observe(len(buffer))
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            # Let the read unwind before the caller closes the underlying stream
+            await asyncio.gather(pending, return_exceptions=True)
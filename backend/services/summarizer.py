@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import database, crud
+from config import settings
+from .llm import llm_service
+from .turn import chat_stage_seconds, chat_errors_total
+
+logger = logging.getLogger("RealEgo")
+
+class ConversationSummarizer:
+    """
+    Keeps a rolling summary of each user's older chat messages in the
+    conversation_summaries table, so the prompt carries the summary plus the
+    raw messages after it instead of an ever longer history.
+
+    save_turn calls schedule() after each reply. Once SUMMARY_EVERY_MESSAGES
+    messages have piled up beyond the newest SUMMARY_KEEP_RECENT (which stay
+    raw for the prompt), the older ones are folded into the summary by one LLM
+    call in a background task, never on the request path. At most one summary
+    update per user runs at a time in this process; a second process doing the
+    same work concurrently only costs a redundant call, the last write wins.
+    """
+    def __init__(self):
+        self._running = {} # user_id -> task
+
+    def schedule(self, user_id: int):
+        if settings.SUMMARY_EVERY_MESSAGES <= 0 or user_id in self._running:
+            return
+        task = asyncio.create_task(self._run(user_id))
+        self._running[user_id] = task
+        task.add_done_callback(lambda _: self._running.pop(user_id, None))
+
+    async def stop(self):
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, user_id: int):
+        try:
+            await self.update(user_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            chat_errors_total.inc(stage="summarize")
+            logger.error(f"Failed to update conversation summary for user {user_id}: {e!r}")
+
+    async def update(self, user_id: int):
+        """
+        Fold due messages into the user's summary and return how many were
+        folded (0 while fewer than SUMMARY_EVERY_MESSAGES are due). A long
+        backlog is worked off SUMMARY_BATCH_MESSAGES at a time.
+        """
+        folded = 0
+        while True:
+            async with database.AsyncSessionLocal() as db:
+                summary = await crud.get_summary_async(db, user_id)
+                last_id = summary.last_message_id if summary else 0
+                pending = await crud.count_chat_messages_after_async(db, user_id, last_id)
+                due = pending - settings.SUMMARY_KEEP_RECENT
+                if due < max(settings.SUMMARY_EVERY_MESSAGES, 1):
+                    return folded
+                rows = await crud.get_chat_history_page_async(db, user_id, min(due, settings.SUMMARY_BATCH_MESSAGES), after_id=last_id)
+                if not rows:
+                    return folded
+                previous = summary.summary if summary else ""
+
+            with chat_stage_seconds.time(stage="summarize"):
+                text = await llm_service.summarize_conversation(previous, [{"role": r.role, "content": r.content} for r in rows])
+
+            async with database.AsyncSessionLocal() as db:
+                await crud.save_summary_async(db, user_id, text, rows[-1].id)
+            folded += len(rows)
+            logger.info(f"Folded {len(rows)} messages into the conversation summary of user {user_id} (up to id {rows[-1].id})")
+
+conversation_summarizer = ConversationSummarizer()
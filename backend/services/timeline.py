@@ -0,0 +1,94 @@
+import json
+import re
+
+# Timeline categories in display order: key -> (description for the extraction prompt, routing keywords)
+CATEGORIES = {
+    "0_birth": ("Birth (Time, Location, etc.)", (
+        "born", "birth", "birthday", "hometown", "出生", "生日", "生于", "老家", "家乡",
+    )),
+    "1_early_childhood": ("0-6 years old experiences", (
+        "baby", "toddler", "kindergarten", "preschool", "little kid", "early childhood", "when i was little",
+        "幼儿园", "小时候", "童年", "婴儿", "学前",
+    )),
+    "2_primary_edu": ("Primary/Secondary Education & Events", (
+        "primary school", "elementary", "middle school", "high school", "secondary", "classmate", "teacher", "gaokao",
+        "小学", "初中", "高中", "中学", "同学", "老师", "高考",
+    )),
+    "3_higher_edu": ("Higher Education & Events", (
+        "university", "college", "bachelor", "master", "phd", "degree", "graduate", "campus", "major",
+        "大学", "本科", "硕士", "博士", "研究生", "学位", "毕业", "专业", "读研",
+    )),
+    "4_family": ("Family Relations", (
+        "family", "father", "mother", "dad", "mom", "parent", "brother", "sister", "wife", "husband", "son", "daughter",
+        "child", "grandfather", "grandmother", "married", "cousin", "uncle", "aunt",
+        "家人", "家庭", "父亲", "母亲", "爸爸", "妈妈", "爸", "妈", "哥哥", "姐姐", "弟弟", "妹妹", "妻子", "老婆",
+        "丈夫", "老公", "儿子", "女儿", "孩子", "爷爷", "奶奶", "外公", "外婆", "结婚", "亲戚",
+    )),
+    "5_social": ("Social Relations (Friends)", (
+        "friend", "buddy", "roommate", "neighbor", "club", "community", "girlfriend", "boyfriend",
+        "朋友", "好友", "室友", "邻居", "社团", "圈子", "女朋友", "男朋友",
+    )),
+    "6_work": ("Work History", (
+        "work", "job", "company", "career", "boss", "colleague", "employer", "office", "promoted", "startup", "salary",
+        "工作", "公司", "职业", "老板", "同事", "上班", "单位", "升职", "创业", "工资", "辞职", "入职",
+    )),
+    "7_locations": ("Locations (Residence, Work, Past)", (
+        "live in", "lived in", "moved", "move to", "city", "apartment", "house", "relocate", "country",
+        "住在", "搬家", "搬到", "城市", "居住", "房子", "定居", "来到",
+    )),
+    "8_assets": ("Assets", (
+        "money", "asset", "property", "car", "savings", "invest", "stock", "fund", "mortgage", "loan", "bought a",
+        "钱", "资产", "房产", "车", "存款", "投资", "股票", "基金", "房贷", "贷款", "买了",
+    )),
+}
+
+def _keyword_pattern(keywords) -> re.Pattern:
+    # English matches from a word start allowing short suffixes ("friends", "moved"), so "car"
+    # does not match "career"; Chinese has no word boundaries and matches anywhere
+    parts = [rf"\b{re.escape(k)}\w{{0,3}}\b" if k.isascii() else re.escape(k) for k in keywords]
+    return re.compile("|".join(parts), re.IGNORECASE)
+
+_ROUTES = {key: _keyword_pattern(keywords) for key, (_, keywords) in CATEGORIES.items()}
+
+def route_categories(text: str) -> list:
+    """
+    Categories the text probably touches, by keyword. Used to send the extraction
+    prompt only the current data it may need; an empty result means no hint,
+    and the caller should fall back to every category.
+    """
+    return [key for key, pattern in _ROUTES.items() if pattern.search(text)]
+
+def _is_empty(value) -> bool:
+    return value is None or value == "" or value == {} or value == []
+
+def merge_update(current: dict, update: dict, seen: list) -> dict:
+    """
+    Apply an extraction result to the current timeline and return only the
+    categories whose value changed. Categories in `seen` had their current data
+    in the prompt, so the LLM's value replaces it. For any other category the
+    LLM did not see what is stored, so non-empty text is appended rather than
+    overwritten. Unknown keys and empty values are ignored.
+    """
+    changed = {}
+    for key, value in update.items():
+        if key not in CATEGORIES or _is_empty(value):
+            continue
+        existing = current.get(key)
+        if key not in seen and not _is_empty(existing) and existing != value:
+            if isinstance(existing, str) and isinstance(value, str):
+                value = value if value in existing else f"{existing}\n{value}"
+            elif isinstance(existing, dict) and isinstance(value, dict):
+                value = {**existing, **value}
+        if existing != value:
+            current[key] = value
+            changed[key] = value
+    return changed
+
+def encode_value(value) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+def decode_value(content: str):
+    try:
+        return json.loads(content)
+    except (TypeError, ValueError):
+        return content
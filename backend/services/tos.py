@@ -1,45 +1,266 @@
 import tos
+from tos.enum import HttpMethodType
+from tos.models2 import UploadedPart
 from config import settings
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import hashlib
+import logging
 import os
+import threading
+import time
+from .metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger("RealEgo")
+
+upload_bytes_total = Counter("realego_upload_bytes_total", "Bytes sent to TOS, incremented per part as uploads progress")
+upload_seconds = Histogram("realego_upload_seconds", "Wall time of a whole upload to TOS", labelnames=("mode",))
+upload_throughput = Histogram(
+    "realego_upload_throughput_bytes_per_second",
+    "Per-upload throughput to TOS",
+    buckets=(64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6),
+)
+upload_deduplicated_total = Counter(
+    "realego_upload_deduplicated_total",
+    "Uploads answered from the content index without storing the bytes again (check = client pre-check, upload = after hashing the upload)",
+    labelnames=("stage",),
+)
+upload_parts_in_flight = Gauge("realego_upload_parts_in_flight", "Multipart parts currently being sent to TOS")
+
+class UploadTooLarge(Exception):
+    pass
+
+async def _read_part(file, size: int) -> bytes:
+    # UploadFile.read may return short reads; fill the part unless the file ends
+    chunks, remaining = [], size
+    while remaining > 0:
+        chunk = await file.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
 
 class TOSService:
+    """
+    Volcengine TOS access. The SDK client is created on first use and the bucket
+    is checked once (head, create if missing), so importing the module or
+    starting a worker makes no remote call. Every SDK call goes through _call,
+    which runs it on a dedicated thread pool (the SDK is blocking) and caps how
+    many are in flight; the client's pooled connections are reused across calls.
+    """
     def __init__(self):
         self.endpoint = settings.TOS_ENDPOINT
         self.region = settings.TOS_REGION
         self.ak = settings.TOS_AK
         self.sk = settings.TOS_SK
         self.bucket = settings.TOS_BUCKET
-        
-        # Initialize client
-        # Note: Assuming 'tos' package usage based on Volcengine standards
-        try:
-            self.client = tos.TosClientV2(
-                self.ak,
-                self.sk,
-                self.endpoint,
-                self.region
+        self._client = None
+        self._bucket_checked = False
+        self._init_lock = threading.Lock()
+        self._bucket_lock = threading.Lock() # Held during the remote bucket check, never from the event loop
+        self._executor = None
+        # Callers beyond the pool size wait here instead of piling up in the executor queue
+        self._slots = asyncio.Semaphore(settings.TOS_MAX_WORKERS)
+
+    @property
+    def client(self):
+        """The SDK client, created on first access. Creating it is local, no request is made."""
+        if self._client is None:
+            with self._init_lock:
+                if self._client is None:
+                    # Note: Assuming 'tos' package usage based on Volcengine standards
+                    self._client = tos.TosClientV2(
+                        self.ak,
+                        self.sk,
+                        self.endpoint,
+                        self.region,
+                        connection_time=settings.TOS_CONNECT_TIMEOUT,
+                        socket_timeout=settings.TOS_SOCKET_TIMEOUT,
+                        request_timeout=settings.TOS_SOCKET_TIMEOUT,
+                        max_retry_count=settings.TOS_MAX_RETRIES,
+                        max_connections=settings.TOS_MAX_CONNECTIONS,
+                    )
+        return self._client
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._init_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=settings.TOS_MAX_WORKERS, thread_name_prefix="tos")
+        return self._executor
+
+    def _ready_client(self):
+        # Blocking; runs on the executor before the first bucket operation
+        client = self.client
+        if not self._bucket_checked:
+            with self._bucket_lock:
+                if not self._bucket_checked:
+                    try:
+                        client.head_bucket(self.bucket)
+                    except tos.exceptions.TosServerError as e:
+                        if e.status_code != 404:
+                            raise
+                        logger.info(f"TOS bucket {self.bucket} not found, creating it")
+                        client.create_bucket(self.bucket)
+                    self._bucket_checked = True
+        return client
+
+    def _call_sync(self, method: str, *args, **kwargs):
+        return getattr(self._ready_client(), method)(self.bucket, *args, **kwargs)
+
+    async def _call(self, method: str, *args, **kwargs):
+        """Run client.<method>(bucket, *args, **kwargs) on the TOS thread pool."""
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(self._call_sync, method, *args, **kwargs)
             )
-            # Create bucket if not exists
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def object_url(self, object_key: str) -> str:
+        # Generate a signed URL or public URL if needed.
+        # For now returning the object key or direct link logic.
+        return f"https://{self.bucket}.{self.endpoint}/{object_key}"
+
+    async def sha256_file(self, file, max_bytes: int = None):
+        """
+        SHA-256 hex digest and size of an async file-like object, read one part
+        at a time and hashed off the event loop. Rewinds the file afterwards.
+        """
+        max_bytes = max_bytes or settings.TOS_UPLOAD_MAX_BYTES
+        digest, size = hashlib.sha256(), 0
+        while True:
+            data = await file.read(settings.TOS_PART_SIZE)
+            if not data:
+                break
+            size += len(data)
+            if size > max_bytes:
+                raise UploadTooLarge(f"File exceeds {max_bytes} bytes")
+            # hashlib releases the GIL on large buffers. Takes a slot like _call, so hashing
+            # cannot fill the pool's queue ahead of SDK calls
+            async with self._slots:
+                await asyncio.get_running_loop().run_in_executor(self.executor, digest.update, data)
+        await file.seek(0)
+        return digest.hexdigest(), size
+
+    async def upload_stream(self, file, object_key: str, content_type: str = None, max_bytes: int = None):
+        """
+        Upload an async file-like object (e.g. UploadFile) part by part, so
+        memory per upload stays around TOS_UPLOAD_MAX_INFLIGHT_PARTS parts of
+        TOS_PART_SIZE bytes whatever the file size. Files that fit in one part
+        go through a single put_object. Raises UploadTooLarge once more than
+        max_bytes were read; a multipart upload that fails is aborted.
+        """
+        max_bytes = max_bytes or settings.TOS_UPLOAD_MAX_BYTES
+        part_size = settings.TOS_PART_SIZE
+        start = time.perf_counter()
+
+        data = await _read_part(file, part_size)
+        if len(data) > max_bytes:
+            raise UploadTooLarge(f"File exceeds {max_bytes} bytes")
+        next_data = await _read_part(file, part_size) if len(data) == part_size else b""
+        if not next_data:
+            await self._call("put_object", object_key, content=data, content_type=content_type)
+            upload_bytes_total.inc(len(data))
+            self._observe("single", len(data), start)
+            return self.object_url(object_key)
+
+        upload = await self._call("create_multipart_upload", object_key, content_type=content_type)
+        upload_id = upload.upload_id
+        pending, parts, total = set(), [], 0
+        try:
+            part_number = 0
+            while data:
+                total += len(data)
+                if total > max_bytes:
+                    raise UploadTooLarge(f"File exceeds {max_bytes} bytes")
+                part_number += 1
+                pending.add(asyncio.create_task(self._upload_part(object_key, upload_id, part_number, data)))
+                if len(pending) >= settings.TOS_UPLOAD_MAX_INFLIGHT_PARTS:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    parts += [task.result() for task in done]
+                data, next_data = next_data, await _read_part(file, part_size)
+            if pending:
+                parts += [task.result() for task in (await asyncio.wait(pending))[0]]
+                pending = set()
+            parts.sort(key=lambda p: p.part_number)
+            await self._call("complete_multipart_upload", object_key, upload_id, parts=parts)
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
             try:
-                self.client.create_bucket(self.bucket)
+                await self._call("abort_multipart_upload", object_key, upload_id)
             except Exception as e:
-                # Bucket might already exist
-                pass
-        except Exception as e:
-            print(f"Failed to initialize TOS client: {e}")
-            self.client = None
-
-    def upload_file(self, file_content, object_key):
-        if not self.client:
-            raise Exception("TOS Client not initialized")
-        
+                logger.warning(f"Failed to abort multipart upload {upload_id} for {object_key}: {e!r}")
+            raise
+        self._observe("multipart", total, start)
+        logger.info(f"Uploaded {object_key} in {len(parts)} parts ({total} bytes)")
+        return self.object_url(object_key)
+
+    async def _upload_part(self, object_key: str, upload_id: str, part_number: int, data: bytes):
+        with upload_parts_in_flight.track_inprogress():
+            result = await self._call(
+                "upload_part", object_key, upload_id, part_number,
+                content_length=len(data), content=data,
+            )
+        upload_bytes_total.inc(len(data))
+        logger.debug(f"Uploaded part {part_number} of {object_key} ({len(data)} bytes)")
+        return UploadedPart(part_number, result.etag)
+
+    # Direct-to-bucket uploads: the browser PUTs the bytes to presigned URLs and
+    # the API only signs, completes and records. The bucket's CORS rules must
+    # allow PUT from the site and expose the ETag header for multipart uploads.
+
+    def presign_put(self, object_key: str, part_number: int = None, upload_id: str = None) -> str:
+        # Signing is a local HMAC, no request to TOS
+        query = {"partNumber": str(part_number), "uploadId": upload_id} if upload_id else None
+        return self.client.pre_signed_url(
+            HttpMethodType.Http_Method_Put, self.bucket, object_key,
+            expires=settings.TOS_PRESIGN_EXPIRES, query=query,
+        ).signed_url
+
+    async def presign_multipart(self, object_key: str, size: int, content_type: str = None):
+        """Start a multipart upload and sign one PUT URL per TOS_PART_SIZE part."""
+        upload = await self._call("create_multipart_upload", object_key, content_type=content_type)
+        part_count = -(-size // settings.TOS_PART_SIZE)
+        urls = [self.presign_put(object_key, n, upload.upload_id) for n in range(1, part_count + 1)]
+        return upload.upload_id, urls
+
+    async def complete_multipart(self, object_key: str, upload_id: str, parts: list):
+        """parts: [(part_number, etag), ...] as reported by the client."""
+        uploaded = sorted((UploadedPart(n, etag) for n, etag in parts), key=lambda p: p.part_number)
+        await self._call("complete_multipart_upload", object_key, upload_id, parts=uploaded)
+
+    async def abort_multipart(self, object_key: str, upload_id: str):
+        await self._call("abort_multipart_upload", object_key, upload_id)
+
+    async def object_size(self, object_key: str):
+        """Size of a stored object in bytes, or None if it does not exist."""
         try:
-            self.client.put_object(self.bucket, object_key, content=file_content)
-            # Generate a signed URL or public URL if needed. 
-            # For now returning the object key or direct link logic.
-            return f"https://{self.bucket}.{self.endpoint}/{object_key}"
-        except Exception as e:
-            print(f"Upload failed: {e}")
-            raise e
+            head = await self._call("head_object", object_key)
+        except tos.exceptions.TosServerError as e:
+            if e.status_code == 404:
+                return None
+            raise
+        return head.content_length
+
+    async def delete_object(self, object_key: str):
+        await self._call("delete_object", object_key)
+
+    def _observe(self, mode: str, size: int, start: float):
+        elapsed = time.perf_counter() - start
+        upload_seconds.observe(elapsed, mode=mode)
+        if elapsed > 0:
+            upload_throughput.observe(size / elapsed)
 
 tos_service = TOSService()
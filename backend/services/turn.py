@@ -0,0 +1,88 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from .metrics import Counter, Histogram
+
+chat_stage_seconds = Histogram(
+    "realego_chat_stage_seconds",
+    "Duration of each chat pipeline stage (profile, memory_search, history, llm_connect, time_to_first_token, stream, db_write, memory_add, summarize)",
+    labelnames=("stage",),
+)
+chat_tokens_per_second = Histogram(
+    "realego_chat_tokens_per_second",
+    "Streamed LLM output rate per turn, counting one token per delta",
+    buckets=(1, 5, 10, 20, 30, 50, 75, 100, 150, 200),
+)
+chat_errors_total = Counter("realego_chat_errors_total", "Chat pipeline failures by stage", labelnames=("stage",))
+
+class TurnContext:
+    """
+    Per-turn state for a chat request: who is asking, what was asked, and
+    everything retrieved for it (profile, memories, summary, history) plus how long each step took.
+    Built once by the chat router and passed to LLMService.chat_with_context,
+    so retrieval is never repeated inside the LLM call.
+    """
+    def __init__(self, user_id: str, username: str, message: str, received_at: float = None):
+        self.user_id = user_id
+        self.username = username
+        self.message = message
+        self.profile = {"username": username}
+        self.memories = []
+        self.summary = "" # Rolling summary of the turns before history (services/summarizer.py)
+        self.history = [] # Prior turns as [{"role": ..., "content": ...}], oldest first
+        self.timings = {} # stage name -> seconds
+        self.prompt_tokens = {} # prompt section -> tokens, set when the prompt is built
+        # When the request arrived (perf_counter), before any admission wait; time to first token counts from here
+        self.started_at = time.perf_counter() if received_at is None else received_at
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Time a stage into self.timings and the realego_chat_stage_seconds histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage: str, seconds: float):
+        self.timings[stage] = seconds
+        chat_stage_seconds.observe(seconds, stage=stage)
+
+    def set_profile(self, profile):
+        """Copy the prompt-relevant fields from a models.Profile row."""
+        if not profile:
+            return
+        self.profile = {
+            "username": self.username,
+            "full_name": profile.full_name,
+            "birth_date": str(profile.birth_date) if profile.birth_date else None,
+            "location": profile.location,
+            "family_info": profile.family_info
+        }
+
+    async def fan_out(self, sources: dict):
+        """
+        Run independent retrieval steps concurrently.
+        sources: {stage: (awaitable, timeout_seconds)}. Yields (stage, result, error)
+        in completion order; a step that raises or times out yields its error and a
+        None result, so the caller can degrade instead of failing the turn.
+        Pre-LLM latency becomes the slowest source rather than the sum.
+        """
+        async def run(stage, awaitable, timeout):
+            start = time.perf_counter()
+            try:
+                return stage, await asyncio.wait_for(awaitable, timeout), None
+            except Exception as e:
+                chat_errors_total.inc(stage=stage)
+                return stage, None, e
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        tasks = [asyncio.create_task(run(stage, aw, timeout)) for stage, (aw, timeout) in sources.items()]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # Consumer went away (client disconnect): don't leave retrievals running
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import uuid
+from config import settings
+from .metrics import Counter, Gauge
+from .stream import json_encoder
+
+logger = logging.getLogger("RealEgo")
+
+chat_streams_active = Gauge("realego_chat_streams_active", "Chat turns held in the replay buffer (generating or awaiting reconnects)")
+chat_stream_cancelled_total = Counter(
+    "realego_chat_stream_cancelled_total",
+    "Chat turns stopped before the reply was complete (requested, abandoned = no reader for CHAT_STREAM_ABANDON_SECONDS, shutdown)",
+    labelnames=("reason",),
+)
+chat_stream_resumes_total = Counter(
+    "realego_chat_stream_resumes_total",
+    "Reconnects to a chat stream by result (resumed, expired = offset no longer buffered, not_found)",
+    labelnames=("result",),
+)
+
+class StreamExpired(Exception):
+    pass
+
+class TurnStream:
+    """
+    The events of one chat turn, as JSON frames (one per event), kept in
+    memory while the turn generates and for CHAT_STREAM_REPLAY_TTL seconds
+    after. Readers follow it from any offset (the number of events they
+    already have); frame 0 is {"type": "stream", "content": <id>}. Past
+    CHAT_STREAM_REPLAY_BYTES the oldest frames are dropped.
+
+    Readers are counted: once the last one leaves (the client disconnected)
+    and none comes back within CHAT_STREAM_ABANDON_SECONDS, generation is
+    cancelled, which closes the upstream LLM stream.
+    """
+    def __init__(self, user_id: int):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.frames = []
+        self.base = 0 # Offset of frames[0]
+        self.size = 0 # Bytes held
+        self.done = False
+        self.task = None
+        self.cancel_reason = None
+        self.readers = 0
+        self._idle = 0 # Bumped per disconnect, so only the latest abandon timer acts
+        self._changed = asyncio.Event()
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.frames)
+
+    def append(self, frame: bytes):
+        self.frames.append(frame)
+        self.size += len(frame)
+        if self.size > settings.CHAT_STREAM_REPLAY_BYTES and len(self.frames) > 1:
+            drop = 0
+            while self.size > settings.CHAT_STREAM_REPLAY_BYTES and drop < len(self.frames) - 1:
+                self.size -= len(self.frames[drop])
+                drop += 1
+            del self.frames[:drop]
+            self.base += drop
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        # Wake every reader waiting for this change; later waits use a fresh event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def cancel(self, reason: str) -> bool:
+        """Stop generating; the reply so far is kept, marked truncated. False if the turn already ended."""
+        if self.done or self.task is None or self.task.done() or self.cancel_reason:
+            return False
+        self.cancel_reason = reason
+        self.task.cancel()
+        return True
+
+    def _abandon(self, idle: int):
+        if self.readers == 0 and self._idle == idle and self.cancel("abandoned"):
+            logger.info(f"Chat stream {self.id} has had no reader for {settings.CHAT_STREAM_ABANDON_SECONDS}s, cancelling generation")
+
+    async def follow(self, offset: int = 0):
+        """Frames from offset on, waiting for new ones until the turn is done."""
+        self.readers += 1
+        try:
+            while True:
+                changed = self._changed
+                while offset < self.end:
+                    if offset < self.base:
+                        raise StreamExpired(f"Offset {offset} is no longer buffered (oldest is {self.base})")
+                    yield self.frames[offset - self.base]
+                    offset += 1
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0 and not self.done:
+                self._idle += 1
+                asyncio.get_running_loop().call_later(settings.CHAT_STREAM_ABANDON_SECONDS, self._abandon, self._idle)
+
+class TurnStreamRegistry:
+    """
+    Runs chat turns as tasks of their own, independent of the request that
+    started them, and keeps their output for reconnects (GET /chat/stream/{id}).
+    A client that drops mid-answer resumes from the events it has instead of
+    sending the message again, so the turn is generated and stored once.
+    Streams live in this process only, like response_cache.
+    """
+    def __init__(self):
+        self._streams = {} # id -> TurnStream
+
+    def start(self, user_id: int, frames, finalize=None) -> TurnStream:
+        """
+        Collect an async iterator of JSON frames into a new stream. finalize,
+        an async callable, runs once all frames are in or the turn was
+        cancelled (e.g. to persist the reply).
+        """
+        stream = TurnStream(user_id)
+        stream.append(json_encoder.event("stream", stream.id))
+        self._streams[stream.id] = stream
+        chat_streams_active.inc()
+        stream.task = asyncio.create_task(self._run(stream, frames, finalize))
+        return stream
+
+    def get(self, stream_id: str, user_id: int):
+        stream = self._streams.get(stream_id)
+        if stream is None or stream.user_id != user_id:
+            return None
+        return stream
+
+    async def _run(self, stream: TurnStream, frames, finalize):
+        try:
+            try:
+                async for frame in frames:
+                    stream.append(frame)
+            except asyncio.CancelledError:
+                # Cancelling unwinds the turn, which closes the LLM stream; the partial reply is still finalized
+                reason = stream.cancel_reason or "shutdown"
+                chat_stream_cancelled_total.inc(reason=reason)
+                stream.append(json_encoder.event("cancelled", reason))
+                logger.info(f"Chat stream {stream.id} cancelled ({reason})")
+            # Before finishing, so the reply is stored by the time a response ends. A task
+            # of its own, so the cancellation above (or a second one) cannot cut it short
+            if finalize is not None:
+                await asyncio.shield(asyncio.ensure_future(finalize()))
+        except Exception as e:
+            logger.error(f"Chat stream {stream.id} failed: {e!r}")
+        finally:
+            stream.finish()
+            asyncio.get_running_loop().call_later(settings.CHAT_STREAM_REPLAY_TTL, self._expire, stream.id)
+
+    def _expire(self, stream_id: str):
+        if self._streams.pop(stream_id, None) is not None:
+            chat_streams_active.dec()
+
+    async def stop(self):
+        streams = [s for s in self._streams.values() if s.task is not None and not s.task.done()]
+        for stream in streams:
+            stream.cancel("shutdown")
+        await asyncio.gather(*(s.task for s in streams), return_exceptions=True)
+
+turn_streams = TurnStreamRegistry()
@@ -0,0 +1,32 @@
+import asyncio
+import os
+import sys
+import tempfile
+import pytest
+
+# Tests import the backend modules the way main.py does, from the backend directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# A throwaway SQLite database instead of the configured MySQL one (see config.py)
+_db_dir = tempfile.mkdtemp(prefix="realego-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_db_dir}/test.db")
+os.environ.setdefault("ASYNC_DATABASE_URL", f"sqlite+aiosqlite:///{_db_dir}/test.db")
+
+@pytest.fixture
+def run_db():
+    """
+    Fresh tables for one test. Returns run(coro), which is asyncio.run plus
+    closing the async engine's connections, since they belong to that loop.
+    """
+    import database, models # noqa: F401 - models registers the tables
+
+    async def run(coro):
+        try:
+            return await coro
+        finally:
+            await database.async_engine.dispose()
+
+    database.Base.metadata.create_all(database.engine)
+    yield lambda coro: asyncio.run(run(coro))
+    database.Base.metadata.drop_all(database.engine)
+    database.engine.dispose()
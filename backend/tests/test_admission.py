@@ -0,0 +1,43 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from config import settings
+from services.admission import AdmissionController
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(settings, "LLM_MAX_CONCURRENT", 32)
+    monkeypatch.setattr(settings, "LLM_MAX_CONCURRENT_PER_USER", 1)
+    monkeypatch.setattr(settings, "LLM_MAX_WAITING", 64)
+    monkeypatch.setattr(settings, "LLM_ADMISSION_TIMEOUT", 0.2)
+
+def test_user_at_own_limit_does_not_block_others(limits):
+    async def run():
+        controller = AdmissionController()
+        first = await controller.acquire(1)
+        # User 1's second turn queues behind its own limit...
+        queued = asyncio.create_task(controller.acquire(1))
+        await asyncio.sleep(0)
+        assert not queued.done()
+        # ...while user 2 is admitted at once, with global slots free
+        other = await asyncio.wait_for(controller.acquire(2), 0.05)
+        assert controller.active == 2
+        first.release()
+        second = await queued
+        second.release()
+        other.release()
+        assert controller.active == 0
+
+    asyncio.run(run())
+
+def test_queued_user_times_out_with_429(limits):
+    async def run():
+        controller = AdmissionController()
+        held = await controller.acquire(1)
+        with pytest.raises(HTTPException) as e:
+            await controller.acquire(1)
+        assert e.value.status_code == 429 and "Retry-After" in e.value.headers
+        held.release()
+        assert controller.active == 0 and not controller._waiters
+
+    asyncio.run(run())
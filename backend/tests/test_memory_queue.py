@@ -0,0 +1,113 @@
+import asyncio
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+import database, models
+from config import settings
+from services.mem0 import mem0_service
+from services.memory_queue import memory_queue
+
+Outbox = models.MemoryOutbox
+
+async def enqueue(user_id: int, text: str, due: bool = True):
+    async with database.AsyncSessionLocal() as db:
+        await memory_queue.enqueue(db, [{"role": "user", "content": text}], user_id)
+        if due:
+            await db.execute(update(Outbox).where(Outbox.user_id == user_id).values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+            await db.commit()
+
+async def outbox_rows():
+    async with database.AsyncSessionLocal() as db:
+        return (await db.execute(select(Outbox).order_by(Outbox.id))).scalars().all()
+
+def fake_submit(monkeypatch, calls: list, fail: bool = False, delay: float = 0):
+    async def submit_memory(messages, user_id):
+        calls.append((user_id, [m["content"] for m in messages]))
+        await asyncio.sleep(delay)
+        if fail:
+            raise RuntimeError("Mem0 is down")
+        return {"results": [{"event_id": f"ev-{user_id}", "status": "PENDING"}]}
+    monkeypatch.setattr(mem0_service, "submit_memory", submit_memory)
+
+def test_claim_batches_turns_per_user(run_db, monkeypatch):
+    calls = []
+    fake_submit(monkeypatch, calls)
+    async def run():
+        await enqueue(1, "a")
+        await enqueue(1, "b", due=False) # Still in its batch delay, rides along with "a"
+        await enqueue(2, "c")
+        assert await memory_queue.process_pending() == 2
+        assert sorted(calls) == [("1", ["a", "b"]), ("2", ["c"])]
+        rows = await outbox_rows()
+        assert {(r.status, r.event_id) for r in rows} == {("submitted", "ev-1"), ("submitted", "ev-2")}
+        # Nothing is due any more
+        assert await memory_queue.process_pending() == 0
+
+    run_db(run())
+
+def test_batches_are_submitted_concurrently(run_db, monkeypatch):
+    calls = []
+    fake_submit(monkeypatch, calls, delay=0.2)
+    async def run():
+        for user_id in (1, 2, 3, 4):
+            await enqueue(user_id, "x")
+        start = asyncio.get_running_loop().time()
+        assert await memory_queue.process_pending() == 4
+        assert asyncio.get_running_loop().time() - start < 0.6
+
+    run_db(run())
+
+def test_failed_submit_is_retried_with_backoff(run_db, monkeypatch):
+    monkeypatch.setattr(settings, "MEMORY_QUEUE_MAX_ATTEMPTS", 2)
+    calls = []
+    fake_submit(monkeypatch, calls, fail=True)
+    async def run():
+        await enqueue(1, "a")
+        await memory_queue.process_pending()
+        row, = await outbox_rows()
+        assert (row.status, row.attempts) == ("pending", 1)
+        assert row.next_attempt_at > datetime.utcnow() + timedelta(seconds=settings.MEMORY_QUEUE_RETRY_BASE / 2)
+        assert "Mem0 is down" in row.last_error
+
+        await enqueue(1, "b", due=False)
+        async with database.AsyncSessionLocal() as db:
+            await db.execute(update(Outbox).values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+            await db.commit()
+        await memory_queue.process_pending()
+        # The second failure reaches MEMORY_QUEUE_MAX_ATTEMPTS for the row that failed before
+        assert [(r.status, r.attempts) for r in await outbox_rows()] == [("failed", 2), ("failed", 2)]
+
+    run_db(run())
+
+def test_claimed_rows_are_leased(run_db):
+    async def run():
+        await enqueue(1, "a")
+        claimed = await memory_queue._claim_pending()
+        assert list(claimed) == [1]
+        row, = await outbox_rows()
+        assert row.status == "submitting"
+        assert row.next_attempt_at > datetime.utcnow() + timedelta(seconds=settings.MEMORY_QUEUE_LEASE / 2)
+        # Held by the lease: another worker finds nothing
+        assert await memory_queue._claim_pending() == {}
+        # A worker that died mid-submit: once the lease ran out the rows are claimed again
+        async with database.AsyncSessionLocal() as db:
+            await db.execute(update(Outbox).values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+            await db.commit()
+        assert list(await memory_queue._claim_pending()) == [1]
+
+    run_db(run())
+
+def test_claim_fits_in_the_lease(run_db, monkeypatch):
+    # Calls may take 2 * (0.5 + 2) = 5s each, 2 at a time: a 10s lease fits 2 rounds, 4 batches
+    monkeypatch.setattr(settings, "MEMORY_QUEUE_LEASE", 10)
+    monkeypatch.setattr(settings, "MEM0_CONNECT_TIMEOUT", 0.5)
+    monkeypatch.setattr(settings, "MEM0_TIMEOUT", 2)
+    monkeypatch.setattr(settings, "MEM0_WRITE_CONCURRENCY", 2)
+    async def run():
+        for user_id in range(1, 7):
+            await enqueue(user_id, "x")
+        assert sorted(await memory_queue._claim_pending()) == [1, 2, 3, 4]
+        rows = await outbox_rows()
+        assert [r.status for r in rows] == ["submitting"] * 4 + ["pending"] * 2
+        assert sorted(await memory_queue._claim_pending()) == [5, 6]
+
+    run_db(run())
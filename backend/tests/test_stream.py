@@ -0,0 +1,54 @@
+import asyncio
+from services.stream import coalesce
+
+async def deltas(*steps):
+    # Strings are yielded, numbers are pauses in seconds
+    for step in steps:
+        if isinstance(step, str):
+            yield step
+        else:
+            await asyncio.sleep(step)
+
+async def collect(iterator):
+    return [piece async for piece in iterator]
+
+def test_first_delta_is_sent_at_once():
+    async def run():
+        pieces = coalesce(deltas("a", 5, "b"), window=1, max_chars=100)
+        # The first delta does not wait for the window, even though the next one is slow
+        assert await asyncio.wait_for(pieces.__anext__(), 0.5) == "a"
+        await pieces.aclose()
+
+    asyncio.run(run())
+
+def test_deltas_within_the_window_are_merged():
+    pieces = asyncio.run(collect(coalesce(deltas("a", "b", "c", 0.2, "d"), window=0.05, max_chars=100)))
+    assert pieces == ["a", "bc", "d"]
+
+def test_full_buffer_is_flushed_before_the_window_ends():
+    pieces = asyncio.run(collect(coalesce(deltas("a", "bb", "cc", "d"), window=10, max_chars=3)))
+    assert pieces == ["a", "bbcc", "d"]
+
+def test_zero_window_passes_every_delta_through():
+    pieces = asyncio.run(collect(coalesce(deltas("a", "b", "c"), window=0, max_chars=100)))
+    assert pieces == ["a", "b", "c"]
+
+def test_closing_early_cancels_the_pending_read():
+    async def run():
+        closed = asyncio.Event()
+        async def source():
+            try:
+                yield "a"
+                yield "b"
+                await asyncio.sleep(10)
+                yield "c"
+            finally:
+                closed.set()
+        pieces = coalesce(source(), window=0.05, max_chars=100)
+        assert await pieces.__anext__() == "a"
+        # "b" is flushed by the window while the read of "c" is still pending
+        assert await asyncio.wait_for(pieces.__anext__(), 1) == "b"
+        await pieces.aclose()
+        assert closed.is_set()
+
+    asyncio.run(run())
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import pytest
+from config import settings
+from services.stream import json_encoder
+from services.turn_stream import TurnStreamRegistry, StreamExpired
+
+def types(frames):
+    return [json.loads(frame)["type"] for frame in frames]
+
+async def chunks(*texts, gate: asyncio.Event = None):
+    for text in texts:
+        if gate is not None:
+            await gate.wait()
+            gate.clear()
+        yield json_encoder.chunk(text)
+
+async def follow_all(stream, offset=0):
+    return [frame async for frame in stream.follow(offset)]
+
+def test_replay_from_offset():
+    async def run():
+        registry = TurnStreamRegistry()
+        stream = registry.start(1, chunks("a", "b", "c"))
+        await stream.task
+        frames = await follow_all(stream)
+        assert types(frames) == ["stream", "response_chunk", "response_chunk", "response_chunk"]
+        assert json.loads(frames[0])["content"] == stream.id
+        # A client that already has two events gets the rest
+        assert await follow_all(stream, 2) == frames[2:]
+        assert await follow_all(stream, stream.end) == []
+
+    asyncio.run(run())
+
+def test_resume_follows_a_live_turn():
+    async def run():
+        registry = TurnStreamRegistry()
+        gate = asyncio.Event()
+        stream = registry.start(1, chunks("a", "b", gate=gate))
+        reader = stream.follow(1)
+        gate.set()
+        assert json.loads(await reader.__anext__())["content"] == "a"
+        gate.set()
+        assert json.loads(await reader.__anext__())["content"] == "b"
+        with pytest.raises(StopAsyncIteration):
+            await reader.__anext__()
+        assert stream.done
+
+    asyncio.run(run())
+
+def test_streams_are_private_to_their_user():
+    async def run():
+        registry = TurnStreamRegistry()
+        stream = registry.start(1, chunks("a"))
+        await stream.task
+        assert registry.get(stream.id, 1) is stream
+        assert registry.get(stream.id, 2) is None
+        assert registry.get("missing", 1) is None
+
+    asyncio.run(run())
+
+def test_offset_dropped_from_the_buffer_expires(monkeypatch):
+    monkeypatch.setattr(settings, "CHAT_STREAM_REPLAY_BYTES", 60)
+    async def run():
+        registry = TurnStreamRegistry()
+        stream = registry.start(1, chunks("x" * 20, "y" * 20, "z" * 20))
+        await stream.task
+        # Older frames go once the buffer is over budget; the newest is always kept
+        assert stream.base > 0 and stream.frames
+        with pytest.raises(StreamExpired):
+            await follow_all(stream, 0)
+        assert await follow_all(stream, stream.base) == stream.frames
+
+    asyncio.run(run())
+
+async def forever():
+    yield json_encoder.chunk("a")
+    await asyncio.Event().wait()
+    yield json_encoder.chunk("never")
+
+def test_turn_without_readers_is_abandoned(monkeypatch):
+    monkeypatch.setattr(settings, "CHAT_STREAM_ABANDON_SECONDS", 0.05)
+    async def run():
+        finalized = []
+        async def finalize():
+            finalized.append(True)
+        registry = TurnStreamRegistry()
+        stream = registry.start(1, forever(), finalize)
+        reader = stream.follow(0)
+        await reader.__anext__()
+        await reader.aclose() # The client disconnected
+        await asyncio.wait_for(stream.task, 1)
+        last = json.loads(stream.frames[-1])
+        assert last == {"type": "cancelled", "content": "abandoned"}
+        assert finalized and stream.done
+
+    asyncio.run(run())
+
+def test_reader_back_within_the_grace_period_keeps_the_turn(monkeypatch):
+    monkeypatch.setattr(settings, "CHAT_STREAM_ABANDON_SECONDS", 0.1)
+    async def run():
+        registry = TurnStreamRegistry()
+        stream = registry.start(1, forever())
+        first = stream.follow(0)
+        await first.__anext__()
+        await first.aclose()
+        second = stream.follow(2) # Has the stream event and "a"
+        waiting = asyncio.ensure_future(second.__anext__())
+        await asyncio.sleep(0.3)
+        assert not stream.task.done() and stream.cancel_reason is None
+        assert stream.cancel("requested")
+        await asyncio.wait_for(stream.task, 1)
+        assert json.loads(await waiting)["type"] == "cancelled"
+        assert not stream.cancel("requested") # Already over
+
+    asyncio.run(run())
+
+class FakeCompletion:
+    """A streamed LLM reply that sends "Hel" and then stalls until closed."""
+    def __init__(self):
+        self.closed = False
+
+    async def _chunks(self):
+        from types import SimpleNamespace
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="Hel"))])
+        await asyncio.Event().wait()
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def close(self):
+        self.closed = True
+
+def test_cancelled_chat_turn_is_saved_truncated(run_db, monkeypatch):
+    import database, models, schemas
+    from sqlalchemy import select
+    from routers import chat
+    from services.llm import llm_service
+    from services.mem0 import mem0_service
+
+    completion = FakeCompletion()
+    async def chat_with_context(context, stream=False):
+        return completion
+    async def search_memory(query, user_id):
+        return []
+    monkeypatch.setattr(llm_service, "chat_with_context", chat_with_context)
+    monkeypatch.setattr(mem0_service, "search_memory", search_memory)
+    monkeypatch.setattr(settings, "SUMMARY_EVERY_MESSAGES", 0)
+
+    async def run():
+        async with database.AsyncSessionLocal() as db:
+            response = await chat.chat(schemas.ChatRequest(message="hi"), None, schemas.User(id=1, username="u"), db)
+        stream = chat.turn_streams.get(response.headers["x-stream-id"], 1)
+        for _ in range(200):
+            if "response_chunk" in types(stream.frames):
+                break
+            await asyncio.sleep(0.01)
+        assert stream.cancel("requested")
+        await asyncio.wait_for(stream.task, 2)
+        assert completion.closed
+        assert json.loads(stream.frames[-1]) == {"type": "cancelled", "content": "requested"}
+        async with database.AsyncSessionLocal() as db:
+            rows = (await db.execute(select(models.ChatMessage).order_by(models.ChatMessage.id))).scalars().all()
+            outbox = (await db.execute(select(models.MemoryOutbox))).scalars().all()
+        assert [(r.role, r.content, r.truncated) for r in rows] == [("user", "hi", False), ("assistant", "Hel", True)]
+        assert len(outbox) == 1
+
+    run_db(run())
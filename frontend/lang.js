@@ -29,16 +29,20 @@ const translations = {
         log_profile_loaded: "Profile loaded.",
         log_searching_memories: "Searching relevant memories...",
         log_found_memories: "Found {n} relevant memories.",
+        log_loaded_history: "Loaded {n} recent messages.",
         log_waiting_llm: "Constructing prompt and waiting for LLM...",
         log_llm_received: "LLM response received.",
         log_queueing_storage: "Queueing background memory storage...",
         log_tasks_queued: "All tasks queued. Done.",
+        log_reconnecting: "Connection lost, resuming the reply...",
+        log_cancelled: "Reply stopped before it finished.",
         alert_session_expired: "Session expired. Please login again.",
         alert_profile_saved: "Profile saved!",
         alert_settings_saved: "Settings saved!",
         alert_upload_success: "Uploaded: {filename}",
         alert_upload_fail: "Upload failed",
-        error_server: "Error communicating with server."
+        error_server: "Error communicating with server.",
+        error_busy: "Server is busy, please try again in {n} seconds."
     },
     zh: {
         title: "RealEgo",
@@ -70,16 +74,20 @@ const translations = {
         log_profile_loaded: "档案加载完毕。",
         log_searching_memories: "正在搜索相关记忆...",
         log_found_memories: "找到 {n} 条相关记忆。",
+        log_loaded_history: "已加载 {n} 条近期消息。",
         log_waiting_llm: "构建提示词并等待大模型...",
         log_llm_received: "收到大模型回复。",
         log_queueing_storage: "正在后台存储记忆...",
         log_tasks_queued: "所有任务已加入队列。完成。",
+        log_reconnecting: "连接中断，正在恢复回复...",
+        log_cancelled: "回复在完成前已停止。",
         alert_session_expired: "会话已过期，请重新登录。",
         alert_profile_saved: "档案已保存！",
         alert_settings_saved: "设置已保存！",
         alert_upload_success: "上传成功：{filename}",
         alert_upload_fail: "上传失败",
-        error_server: "服务器通信错误。"
+        error_server: "服务器通信错误。",
+        error_busy: "服务器繁忙，请 {n} 秒后重试。"
     }
 };
 